@@ -0,0 +1,98 @@
+from game import DIRECTIONS, FULL_BOARD, IS_WIN, TicTacToeGame
+from protocol import encode
+
+# TERNARY[bits] spreads a 9-bit bitboard over base 3 digits, so a position's index is
+# TERNARY[x_bits] + 2 * TERNARY[o_bits] (0 = empty, 1 = X, 2 = O for every cell)
+TERNARY = [sum(3 ** cell for cell in range(9) if bits >> cell & 1) for bits in range(512)]
+POSITIONS = 3 ** 9
+
+
+def solve():
+    # Minimax over every position reachable from the empty board. BEST_MOVE[index] is the
+    # cell (1-9) the side to move should play, 0 when the game is already over.
+    best_move = bytearray(POSITIONS)
+    scores = {}
+
+    def search(mover, other):
+        index = TERNARY[mover] + 2 * TERNARY[other] if bin(mover).count("1") == bin(other).count("1") \
+            else TERNARY[other] + 2 * TERNARY[mover]
+        if index in scores:
+            return scores[index]
+        best_score = None
+        taken = mover | other
+        for cell in range(9):
+            bit = 1 << cell
+            if taken & bit:
+                continue
+            moved = mover | bit
+            if IS_WIN[moved]:
+                score = 10 - bin(moved | other).count("1")  # win sooner rather than later
+            elif moved | other == FULL_BOARD:
+                score = 0
+            else:
+                score = -search(other, moved)
+            if best_score is None or score > best_score:
+                best_score = score
+                best_move[index] = cell + 1
+        scores[index] = best_score
+        return best_score
+
+    search(0, 0)
+    return best_move, len(scores)
+
+
+BEST_MOVE, SOLVED_POSITIONS = solve()
+YOUR_TURN = encode("YOUR_TURN")
+
+
+def best_move(x_bits, o_bits):
+    return BEST_MOVE[TERNARY[x_bits] + 2 * TERNARY[o_bits]]
+
+
+def greedy_move(game):
+    # Larger boards can't be solved: play next to the stones already on the board, where
+    # the longest own line or the longest line of the opponent to block goes through
+    size = game.size
+    if not game.cells:
+        return (size // 2) * size + size // 2 + 1
+    symbol = game.turn
+    opponent = 'O' if symbol == 'X' else 'X'
+    best_score, best_cell = -1, None
+    for cell in game.cells:
+        row, column = divmod(cell - 1, size)
+        for r in range(max(0, row - 1), min(size, row + 2)):
+            for c in range(max(0, column - 1), min(size, column + 2)):
+                candidate = r * size + c + 1
+                if candidate in game.cells:
+                    continue
+                own = max(game.line_length(candidate, symbol, direction) for direction in DIRECTIONS)
+                other = max(game.line_length(candidate, opponent, direction) for direction in DIRECTIONS)
+                # Winning beats blocking, blocking a win beats everything else
+                score = own * 2 + 1 if own >= game.win_length else max(own * 2, other * 2 - 1)
+                if score > best_score:
+                    best_score, best_cell = score, candidate
+    return best_cell
+
+
+class BotClient:
+    # Stands in for a player's connection. It ignores what the room sends it except
+    # YOUR_TURN, which it answers by queueing its move on the room.
+    def __init__(self, room, username):
+        self.room = room
+        self.username = username
+        self.address = None
+
+    def send(self, data):
+        if data == YOUR_TURN and self.room.game is not None:
+            game = self.room.game
+            cell = best_move(game.x_bits, game.o_bits) if type(game) is TicTacToeGame else greedy_move(game)
+            self.room.submit(self.room.handle_move, self, self.username, cell)
+
+    def send_chat(self, data):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
@@ -1,6 +1,19 @@
 import tkinter as tk
+import queue
 import socket
 import threading
+import time
+
+from clientlib import (CONNECTED, BinaryDecoder, Board, BoardChanged, BoardState, CellChanged, Chat, Disconnected,
+                       GameOver, Message, MoveResult, Ping, Resumed, SessionStarted, Stats, SymbolAssigned, TextDecoder,
+                       Turn)
+from protocol import BINARY, binary_command, decode, encode
+
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 2 #Seconds between two attempts to resume the session
+UI_REFRESH = 50 #Milliseconds between two passes over the network events
+MAX_EVENTS_PER_PASS = 2000 #Keeps the window responsive when the server sends faster than we draw
+MAX_LOG_LINES = 1000
  
 class Client: #Client class to handle the GUI and the connection to the server
     def __init__(self): #Constructor
@@ -10,9 +23,12 @@ class Client: #Client class to handle the GUI and the connection to the server
         self.root.geometry("500x400")
 
         self.symbol = "" #Symbol of the player
-        self.board = [] #Board of the game
+        self.board = Board() #Board shown in the cells
         self.opponent_username = "" #Username of the opponent
         self.win_count = 0
+        self.session_token = None #Token to resume the session after a lost connection
+        self.events = queue.SimpleQueue() #Network events from the receive thread, only the Tk loop touches widgets
+        self.log_lines = [] #Lines to add to the logs on the next pass
 
         self.logs_frame = tk.Frame(self.root)
         self.logs_frame.pack(side="left")
@@ -31,6 +47,11 @@ class Client: #Client class to handle the GUI and the connection to the server
         self.username_label.pack()
         self.username_entry = tk.Entry(self.root) #Entry widget to get the username
         self.username_entry.pack()
+        self.binary_var = tk.BooleanVar(value=False)
+        self.binary_check = tk.Checkbutton(self.root, text="Binary protocol", variable=self.binary_var) #Smaller messages, for servers that support it
+        self.binary_check.pack()
+        self.binary = False #Protocol of the current connection, read by the receive thread
+        self.state = BoardState(lambda: self.send("BOARD")) #Board as the receive thread knows it, to check the CELL numbers
         self.connect_button = tk.Button(self.root, text="Connect", command=self.connect_and_check)
         self.connect_button.pack()
         self.disconnect_button = tk.Button(self.root, text="Disconnect", command=self.disconnect)
@@ -43,13 +64,21 @@ class Client: #Client class to handle the GUI and the connection to the server
         self.move_button = tk.Button(self.root, text="MOVE", command=self.send_move, state="disabled")
         self.move_button.pack()
 
+        self.chat_label = tk.Label(self.root, text="Chat:")
+        self.chat_label.pack()
+        self.chat_entry = tk.Entry(self.root) #Entry widget to talk to the room
+        self.chat_entry.pack()
+        self.chat_button = tk.Button(self.root, text="Send", command=self.send_chat, state="disabled")
+        self.chat_button.pack()
+
         self.board_frame = tk.Frame(self.root)
         self.board_frame.pack(side="right")
         self.board_label = tk.Label(self.board_frame, text="Board:") 
         self.board_label.pack()
-        self.board_text = tk.Text(self.board_frame, width=20, height=10) #Text widget to display the board
-        self.board_text.pack()
-        self.board_text.config(state="disabled")
+        self.cells_frame = tk.Frame(self.board_frame)
+        self.cells_frame.pack()
+        self.cells = [] #One label per cell, only the cells that change are redrawn
+        self.build_cells(3)
 
         self.logs = tk.Text(self.logs_frame, width=40, height=20) #Text widget to display the logs
         self.logs.pack()
@@ -63,162 +92,260 @@ class Client: #Client class to handle the GUI and the connection to the server
         self.win_display.insert(tk.END, f"{self.win_count}")
         self.win_display.config(state="disabled")
 
-
+        self.root.after(UI_REFRESH, self.process_events)
         self.root.mainloop()
 
     def connect_and_check(self): #Function to connect to the server and check if the connection is successful
         self.connect_button.config(state="disabled") 
-        self.logs.config(state="normal")
-        self.logs.insert(tk.END, "Connecting...\n")
-        self.logs.config(state="disabled")
+        self.log("Connecting...")
 
-        #self.host = self.ip_entry.get() #Get the IP address
-        self.host = "192.168.1.141"
+        self.host = self.ip_entry.get() or "127.0.0.1" #Get the IP address
         self.port = int(self.port_entry.get()) #Get the port number
         self.username = self.username_entry.get() #Get the username
+        self.binary = self.binary_var.get()
 
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #Create a socket
         try:
             self.client_socket.connect((self.host, self.port)) #Connect to the server
         except:
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, "Could not connect to the server\n") #If the connection is unsuccessful display an error message
-            self.logs.config(state="disabled")
+            self.log("Could not connect to the server") #If the connection is unsuccessful display an error message
             self.connect_button.config(state="normal")
             return
 
-        self.client_socket.send(self.username.encode()) #Send the username to the server
-        response = self.client_socket.recv(1024).decode() #Receive a response from the server
-        if response != "MESSAGE Connected to the server": #If the response is not "Connected to the server" display an error message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, "Could not connect to the server\n" + response + "\n") #Display the error message
-            self.logs.config(state="disabled")
+        try:
+            response, rest = self.handshake(self.client_socket, self.username) #Send the username and receive a response from the server
+        except OSError:
+            response, rest = "", b""
+        if response != CONNECTED: #If the response is not "Connected to the server" display an error message
+            self.log("Could not connect to the server\n" + response) #Display the error message
             self.client_socket.close()
             self.connect_button.config(state="normal")
             return
 
-        self.logs.config(state="normal")
-        self.logs.insert(tk.END, "Connected to the server\n") #If the connection is successful display a success message
-        self.logs.config(state="disabled")
+        self.log("Connected to the server") #If the connection is successful display a success message
         self.status_label.config(text="Connected", fg="green")
         self.ip_entry.config(state="disabled")
         self.port_entry.config(state="disabled")
         self.username_entry.config(state="disabled")
+        self.binary_check.config(state="disabled")
         self.connect_button.config(state="disabled")
         self.disconnect_button.config(state="normal")
+        self.chat_button.config(state="normal")
         self.connected = True
 
+        self.decoder = BinaryDecoder() if self.binary else TextDecoder() #Splits the incoming bytes into events
+        self.queue_data(rest) #Handle the messages that arrived together with the response
+
         response_thread = threading.Thread(target=self.receive) #Create a thread to receive messages from the server
         response_thread.start() 
 
     def disconnect(self): #Function to disconnect from the server
-        self.client_socket.send("Disconnect".encode())
+        self.session_token = None #Leaving on purpose, don't resume
+        self.send("Disconnect")
         self.client_socket.close()
 
+    def send(self, message): #Sends a message in the protocol of the connection
+        self.client_socket.send(binary_command(message) if self.binary else encode(message))
+
+    def handshake(self, client_socket, first_line): #Sends the first line, returns the answer and the bytes that came after it
+        client_socket.send(encode(BINARY + first_line if self.binary else first_line))
+        data = b""
+        while b"\n" not in data:
+            chunk = client_socket.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        response, _, rest = data.partition(b"\n")
+        return decode(response), rest
+
     def send_move(self): #Function to send the move to the server
         move = self.move_entry.get() #Get the move
         if not move:
             return
         cell = int(move)
-        if 1 <= cell <= 9: #Check if the move is valid
-            self.client_socket.send(f"MOVE {cell}".encode()) #Send the move to the server
+        if 1 <= cell <= self.board.size ** 2: #Check if the move is valid
+            self.send(f"MOVE {cell}") #Send the move to the server
 
+    def send_chat(self): #Function to send a chat line to everyone in the room
+        text = self.chat_entry.get().strip()
+        if text:
+            self.send(text)
+            self.chat_entry.delete(0, 'end')
 
-    def receive(self): #Function to receive messages from the server
+    def receive(self): #Function to receive messages from the server, runs on its own thread and never touches Tk
         while True: #Loop to receive messages from the server
             try:
-                message = self.client_socket.recv(1024).decode() 
-                self.handle_server_message(message) #Handle the message
+                data = self.client_socket.recv(1024)
+                if not data: #The server closed the connection
+                    raise ConnectionError
+                self.queue_data(data)
             except:
-                self.logs.config(state="normal")
-                self.logs.insert(tk.END, "Error: Connection lost\n")
-                self.logs.config(state="disabled")
-                self.status_label.config(text="Disconnected", fg="red")
-                self.ip_entry.config(state="normal")
-                self.port_entry.config(state="normal")
-                self.username_entry.config(state="normal")
-                self.connect_button.config(state="normal")
-                self.disconnect_button.config(state="disabled")
-                self.move_button.config(state="disabled")
+                if self.session_token and self.resume(): #Keep the seat if the server still holds it
+                    continue
+                self.events.put(Disconnected("connection lost"))
                 break
 
-            
-    def display_board(self, board_repr): #Function to display the board
-            self.board_text.config(state="normal")
-            self.board_text.delete('1.0', tk.END)
-            self.board_text.insert(tk.END, board_repr)
-            self.board_text.config(state="disabled")
-
-    def handle_server_message(self, message): #Function to handle the messages from the server
-        tokens = message.split()
-
-        if tokens[0] == f"SYMBOL": #If the message is "SYMBOL" get the symbol of the player
-            self.symbol = tokens[1]
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"Your symbol is: {self.symbol}\n") #Display the symbol of the player
-            self.logs.config(state="disabled")
-
-        elif tokens[0] == f"BOARD": #If the message is "BOARD" display the board
-            board_data = "".join(tokens[1:])
-            board_repr = board_data[:5] + "\n" + \
-                        board_data[5:10] + "\n" + \
-                        board_data[10:]
-            self.display_board(board_repr) #Display the board
-
-        elif tokens[0] == f"MESSAGE": #If the message is "MESSAGE" display the message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, ' '.join(tokens[1:]) + "\n") #Display the message
-            self.logs.config(state="disabled")
-
-        elif tokens[0] == f"VALID_MOVE": #If the message is "VALID_MOVE" display a success message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"Valid move\n") #Display a success message
-            self.logs.config(state="disabled")
-            self.move_entry.delete(0, 'end')
-
-        elif tokens[0] == f"INVALID_MOVE": #If the message is "INVALID_MOVE" display an error message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"Invalid move!\nTry again\n") #Display an error message
-            self.logs.config(state="disabled")
-            self.move_entry.delete(0, 'end') #Clear the move entry
+    def queue_data(self, data): #Parses what arrived and passes the events on to the Tk loop
+        for event in self.decoder.feed(data):
+            if isinstance(event, Ping): #Answer right away so the server knows the connection is alive
+                self.send("PONG")
+            elif isinstance(event, SessionStarted): #Keep the token to resume the session later
+                self.session_token = event.token
+            elif isinstance(event, CellChanged):
+                if self.state.apply(event): #Deltas that don't follow the board we have are dropped, a gap asks for the board
+                    self.events.put(event)
+            else:
+                if isinstance(event, BoardChanged):
+                    self.state.replace(event.board)
+                elif isinstance(event, Resumed) and event.board is not None:
+                    self.state.replace(event.board)
+                self.events.put(event)
+
+    def resume(self): #Function to reconnect with the session token after the connection was lost
+        self.events.put("Connection lost, reconnecting...")
+        for attempt in range(RESUME_ATTEMPTS):
+            time.sleep(RESUME_DELAY)
+            try:
+                client_socket = socket.create_connection((self.host, self.port))
+                response, rest = self.handshake(client_socket, f"RESUME {self.session_token}")
+            except OSError:
+                continue
+            if response != CONNECTED: #The seat is gone
+                client_socket.close()
+                return False
+            self.client_socket = client_socket
+            self.decoder = BinaryDecoder() if self.binary else TextDecoder()
+            self.queue_data(rest)
+            return True
+        return False
+
+    def process_events(self): #Runs on the Tk loop: applies the queued network events, each cell is redrawn at most once per pass
+        board = None #Last board of the pass
+        cells = {} #Moves of the pass after it
+        try:
+            for _ in range(MAX_EVENTS_PER_PASS):
+                event = self.events.get_nowait()
+                if isinstance(event, BoardChanged):
+                    board = event.board
+                    cells.clear()
+                elif isinstance(event, CellChanged):
+                    cells[event.cell] = event.symbol
+                else:
+                    if isinstance(event, Resumed) and event.board is not None: #Draws a newer board itself
+                        board = None
+                        cells.clear()
+                    self.handle_event(event)
+        except queue.Empty:
+            pass
+        if board is not None:
+            self.display_board(board)
+        for cell, symbol in cells.items():
+            self.display_cell(cell, symbol)
+        self.show_logs()
+        self.root.after(1 if not self.events.empty() else UI_REFRESH, self.process_events)
+
+    def log(self, line): #Adds a line to the logs on the next pass
+        self.log_lines.append(line)
+
+    def show_logs(self): #Adds the pending lines in one go and keeps the last MAX_LOG_LINES
+        if not self.log_lines:
+            return
+        self.logs.config(state="normal")
+        self.logs.insert(tk.END, "\n".join(self.log_lines) + "\n")
+        lines = int(self.logs.index("end-1c").split(".")[0])
+        if lines > MAX_LOG_LINES:
+            self.logs.delete("1.0", f"{lines - MAX_LOG_LINES}.0")
+        self.logs.see(tk.END)
+        self.logs.config(state="disabled")
+        self.log_lines = []
+
+    def build_cells(self, size): #Lays out one label per cell, smaller ones for the larger boards
+        for label in self.cells:
+            label.destroy()
+        width, font_size = (3, 16) if size == 3 else (2, 9)
+        self.cells = []
+        for cell in range(size * size):
+            label = tk.Label(self.cells_frame, text=str(cell + 1), width=width, font=("Courier", font_size), fg="gray", relief="ridge")
+            label.grid(row=cell // size, column=cell % size)
+            self.cells.append(label)
+        self.board = Board([None] * (size * size), size)
+
+    def display_board(self, board): #Function to display the board, only the cells that changed are updated
+        if board.size != self.board.size:
+            self.build_cells(board.size)
+        for cell, (old, new) in enumerate(zip(self.board.cells, board.cells)):
+            if old != new:
+                self.cells[cell].config(text=new or str(cell + 1), fg="black" if new else "gray")
+        self.board = board
+
+    def display_cell(self, cell, symbol): #Function to display one move
+        self.cells[cell - 1].config(text=symbol, fg="black")
+        self.board = self.board.with_cell(cell, symbol)
+
+    def show_wins(self):
+        self.win_display.config(state="normal")
+        self.win_display.delete('1.0', tk.END)
+        self.win_display.insert(tk.END, f"{self.win_count}")
+        self.win_display.config(state="disabled")
+
+    def handle_event(self, event): #Function to handle the events from the server
+        if isinstance(event, str): #A note from the receive thread
+            self.log(event)
+
+        elif isinstance(event, SymbolAssigned): #Get the symbol of the player
+            self.symbol = event.symbol
+            self.log(f"Your symbol is: {self.symbol}") #Display the symbol of the player
 
-        elif tokens[0] == f"YOUR_TURN": #If the message is "YOUR_TURN" enable the move button 
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"It's your turn\n") #Display a success message
-            self.logs.config(state="disabled")
+        elif isinstance(event, Message): #Display the message
+            self.log(event.text)
+
+        elif isinstance(event, Chat): #Display what someone in the room said
+            self.log(event.text)
+
+        elif isinstance(event, MoveResult): #Display whether the move was accepted
+            self.log("Valid move" if event.valid else "Invalid move!\nTry again")
             self.move_entry.delete(0, 'end') #Clear the move entry
-            self.move_button.config(state="normal")
 
-        elif tokens[0] == f"OPPONENT_TURN": #If the message is "OPPONENT_TURN" display a message  
-            self.opponent_username = tokens[1]
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"It's {self.opponent_username}'s turn\n") #Display a message
-            self.logs.config(state="disabled")
+        elif isinstance(event, Turn):
+            if event.mine: #Enable the move button
+                self.log("It's your turn")
+                self.move_button.config(state="normal")
+            else:
+                self.opponent_username = event.player
+                self.log(f"It's {self.opponent_username}'s turn")
+                self.move_button.config(state="disabled")
             self.move_entry.delete(0, 'end') #Clear the move entry
-            self.move_button.config(state="disabled")
 
-        elif tokens[0] == f"Win": #If the message is "WIN" display a message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"You won!\n") #Display a message
-            self.logs.config(state="disabled")
+        elif isinstance(event, GameOver):
+            self.log({"win": "You won!", "loss": "You lost!", "draw": "It's a draw!"}[event.result])
             self.move_button.config(state="disabled")
-            self.win_count += 1
-            self.win_display.config(state="normal")
-            self.win_display.delete('1.0', tk.END)
-            self.win_display.insert(tk.END, f"{self.win_count}")
-            self.win_display.config(state="disabled")
-
-        elif tokens[0] == f"LOSS": #If the message is "LOSS" display a message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"You lost!\n") #Display a message
-            self.logs.config(state="disabled")
-            self.move_button.config(state="disabled")
-
-        elif tokens[0] == f"DRAW": #If the message is "DRAW" display a message
-            self.logs.config(state="normal")
-            self.logs.insert(tk.END, f"It's a draw!\n") #Display a message
-            self.logs.config(state="disabled")
+            if event.result == "win":
+                self.win_count += 1
+                self.show_wins()
+
+        elif isinstance(event, Resumed): #Restore the game after resuming the session
+            self.symbol = event.symbol
+            if event.board is not None: #Larger boards follow in their own message
+                self.display_board(event.board)
+            self.log(f"Back in room {event.room}, your symbol is: {self.symbol}")
+            self.move_button.config(state="normal" if event.turn == self.symbol else "disabled")
+
+        elif isinstance(event, Stats): #Show the wins the server has kept for this username
+            self.win_count = event.wins
+            self.show_wins()
+            self.log(f"Wins: {event.wins}, losses: {event.losses}, draws: {event.draws}, rating: {event.rating}")
+
+        elif isinstance(event, Disconnected):
+            self.log("Error: Connection lost")
+            self.status_label.config(text="Disconnected", fg="red")
+            self.ip_entry.config(state="normal")
+            self.port_entry.config(state="normal")
+            self.username_entry.config(state="normal")
+            self.binary_check.config(state="normal")
+            self.connect_button.config(state="normal")
+            self.disconnect_button.config(state="disabled")
             self.move_button.config(state="disabled")
+            self.chat_button.config(state="disabled")
 
 
         
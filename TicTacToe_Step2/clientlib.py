@@ -0,0 +1,406 @@
+import asyncio
+import functools
+from collections import namedtuple
+
+from protocol import (BINARY, MAX_FRAME, OP_BOARD, OP_CELL_O, OP_CELL_X, OP_DRAW, OP_INVALID_MOVE, OP_LOSS, OP_NAME,
+                      OP_OPPONENT_TURN, OP_PING, OP_PONG, OP_SYMBOL_O, OP_SYMBOL_X, OP_TEXT, OP_TURN_OF, OP_VALID_MOVE,
+                      OP_WIDE_CELL_O, OP_WIDE_CELL_X, OP_WIN, OP_WON, OP_YOUR_TURN, U16, FrameDecoder, binary_command,
+                      decode, encode)
+
+CONNECTED = "MESSAGE Connected to the server"
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 2
+READ_SIZE = 64 * 1024
+
+# Events of a GameSession, one per message from the server
+Message = namedtuple("Message", "text")
+Chat = namedtuple("Chat", "text")
+SessionStarted = namedtuple("SessionStarted", "token")
+Stats = namedtuple("Stats", "wins losses draws rating")
+SymbolAssigned = namedtuple("SymbolAssigned", "symbol")
+BoardChanged = namedtuple("BoardChanged", "board")
+CellChanged = namedtuple("CellChanged", "seq cell symbol")  # seq numbers the moves of a game from 1
+Turn = namedtuple("Turn", "mine player")  # player is None when it is our own turn
+MoveResult = namedtuple("MoveResult", "valid")
+GameOver = namedtuple("GameOver", "result")  # "win", "loss" or "draw"
+Resumed = namedtuple("Resumed", "room symbol turn board")
+Ping = namedtuple("Ping", "")
+Disconnected = namedtuple("Disconnected", "reason")
+
+RESULTS = {"Win": "win", "LOSS": "loss", "DRAW": "draw"}
+
+
+class HandshakeError(ConnectionError):
+    pass
+
+
+class Board:
+    # The size * size cells of a game, "X", "O" or None, numbered from 1 like on the wire
+    __slots__ = ("cells", "size", "win_length")
+
+    def __init__(self, cells=(None,) * 9, size=3, win_length=3):
+        self.cells = tuple(cells)
+        self.size = size
+        self.win_length = win_length
+
+    @classmethod
+    def from_wire(cls, rows):
+        # BOARD payload, e.g. "X|2|3 4|O|6 7|8|9"
+        return cls(cell if cell in ("X", "O") else None for cell in "|".join(rows.split()).split("|"))
+
+    @classmethod
+    def from_cells(cls, cells):
+        # SNAPSHOT payload, e.g. "X234O6789"
+        return cls(cell if cell in ("X", "O") else None for cell in cells)
+
+    @classmethod
+    def from_grid(cls, grid):
+        # GRID payload, e.g. "15 5 113X 98O": size, win length and the occupied cells
+        size, win_length, *played = grid.split()
+        size = int(size)
+        cells = [None] * (size * size)
+        for move in played:
+            cells[int(move[:-1]) - 1] = move[-1]
+        return cls(cells, size, int(win_length))
+
+    def with_cell(self, cell, symbol):
+        cells = list(self.cells)
+        cells[cell - 1] = symbol
+        return Board(cells, self.size, self.win_length)
+
+    def marks(self):
+        return len(self.cells) - self.cells.count(None)
+
+    def __getitem__(self, cell):
+        return self.cells[cell - 1]
+
+    def __eq__(self, other):
+        return isinstance(other, Board) and self.size == other.size and self.cells == other.cells
+
+    def __hash__(self):
+        return hash(self.cells)
+
+    def free_cells(self):
+        return [cell for cell in range(1, len(self.cells) + 1) if self.cells[cell - 1] is None]
+
+    def rows(self):
+        if self.size != 3:
+            return ["".join(self.cells[i] or "." for i in range(row, row + self.size))
+                    for row in range(0, len(self.cells), self.size)]
+        return ["|".join(self.cells[i] or str(i + 1) for i in range(row, row + 3)) for row in (0, 3, 6)]
+
+    def __str__(self):
+        return "\n".join(self.rows())
+
+    def __repr__(self):
+        return f"Board({' '.join(self.rows())})"
+
+
+def parse_message(message):
+    # Turns one message from the server into an event, None for an empty one
+    command, _, rest = message.partition(" ")
+    if command == "BOARD":
+        return BoardChanged(Board.from_wire(rest))
+    if command == "GRID":
+        return BoardChanged(Board.from_grid(rest))
+    if command == "CELL":
+        seq, cell, symbol = rest.split()
+        return CellChanged(int(seq), int(cell), symbol)
+    if command == "YOUR_TURN":
+        return Turn(True, None)
+    if command == "OPPONENT_TURN":
+        return Turn(False, rest)
+    if command in ("VALID_MOVE", "INVALID_MOVE"):
+        return MoveResult(command == "VALID_MOVE")
+    if command == "MESSAGE":
+        return Message(rest)
+    if command == "SYMBOL":
+        return SymbolAssigned(rest.strip())
+    if command in RESULTS:
+        return GameOver(RESULTS[command])
+    if command == "PING":
+        return Ping()
+    if command == "SESSION":
+        return SessionStarted(rest)
+    if command == "STATS":
+        return Stats(*map(int, rest.split()))
+    if command == "SNAPSHOT":
+        room, symbol, turn, cells = rest.split()
+        # Boards larger than 3x3 come in the GRID message that follows
+        return Resumed(int(room), symbol, turn, Board.from_cells(cells) if cells != "-" else None)
+    if not message:
+        return None
+    return Chat(message)
+
+
+@functools.lru_cache(maxsize=None)
+def board_from_base3(value):
+    cells = []
+    for _ in range(9):
+        value, digit = divmod(value, 3)
+        cells.append((None, "X", "O")[digit])
+    return Board(cells)
+
+
+class TextDecoder(FrameDecoder):
+    # Splits the bytes of the text protocol into events
+    def feed(self, data):
+        return [event for event in map(parse_message, super().feed(data)) if event is not None]
+
+
+class BinaryDecoder:
+    # Splits the bytes of the binary protocol into events. Names announced with NAME are
+    # kept for the OPPONENT_TURN frames that refer to them.
+    FIXED = {
+        OP_YOUR_TURN: Turn(True, None), OP_VALID_MOVE: MoveResult(True), OP_INVALID_MOVE: MoveResult(False),
+        OP_SYMBOL_X: SymbolAssigned("X"), OP_SYMBOL_O: SymbolAssigned("O"), OP_WIN: GameOver("win"),
+        OP_LOSS: GameOver("loss"), OP_DRAW: GameOver("draw"), OP_PING: Ping(), OP_PONG: None,
+    }
+
+    def __init__(self):
+        self.buffer = b""
+        self.names = {}
+
+    def feed(self, data):
+        buffer = self.buffer + data if self.buffer else data
+        events = []
+        offset = 0
+        end = len(buffer)
+        while offset < end:
+            opcode = buffer[offset]
+            if opcode in self.FIXED:
+                event = self.FIXED[opcode]
+                offset += 1
+            elif opcode in (OP_BOARD, OP_OPPONENT_TURN, OP_TURN_OF, OP_WON):
+                if offset + 3 > end:
+                    break
+                value, = U16.unpack_from(buffer, offset + 1)
+                offset += 3
+                if opcode == OP_BOARD:
+                    event = BoardChanged(board_from_base3(value))
+                elif opcode == OP_OPPONENT_TURN:
+                    event = Turn(False, self.names.get(value))
+                elif opcode == OP_TURN_OF:
+                    event = Message(f"It's {self.names.get(value)}'s turn.")
+                else:
+                    event = Message(f"{self.names.get(value)} won!")
+            elif opcode == OP_CELL_X or opcode == OP_CELL_O:
+                if offset + 2 > end:
+                    break
+                packed = buffer[offset + 1]
+                event = CellChanged(packed >> 4, packed & 15, "X" if opcode == OP_CELL_X else "O")
+                offset += 2
+            elif opcode == OP_WIDE_CELL_X or opcode == OP_WIDE_CELL_O:
+                if offset + 5 > end:
+                    break
+                seq, = U16.unpack_from(buffer, offset + 1)
+                cell, = U16.unpack_from(buffer, offset + 3)
+                event = CellChanged(seq, cell, "X" if opcode == OP_WIDE_CELL_X else "O")
+                offset += 5
+            elif opcode == OP_TEXT:
+                if offset + 3 > end:
+                    break
+                length, = U16.unpack_from(buffer, offset + 1)
+                if offset + 3 + length > end:
+                    break
+                event = parse_message(decode(buffer[offset + 3:offset + 3 + length]))
+                offset += 3 + length
+            elif opcode == OP_NAME:
+                if offset + 5 > end:
+                    break
+                name_id, = U16.unpack_from(buffer, offset + 1)
+                length, = U16.unpack_from(buffer, offset + 3)
+                if offset + 5 + length > end:
+                    break
+                self.names[name_id] = decode(buffer[offset + 5:offset + 5 + length])
+                offset += 5 + length
+                continue
+            else:
+                raise ValueError(f"Unknown opcode {opcode}")
+            if event is not None:
+                events.append(event)
+        self.buffer = buffer[offset:]
+        if len(self.buffer) > MAX_FRAME:
+            raise ValueError("Frame too long")
+        return events
+
+
+class BoardState:
+    # The board of the current game, from the last full board and the CELL deltas after it.
+    # A delta that skips a number means some were lost: request_board is called to get the
+    # whole board again, and deltas are ignored until it arrives.
+    def __init__(self, request_board):
+        self.request_board = request_board
+        self.board = Board()
+        self.seq = 0
+        self.behind = False
+
+    def replace(self, board):
+        self.board = board
+        self.seq = board.marks()
+        self.behind = False
+
+    def apply(self, delta):
+        # True when the delta changed the board
+        if self.behind or delta.seq <= self.seq:
+            return False
+        if delta.seq > self.seq + 1:
+            self.behind = True
+            self.request_board()
+            return False
+        self.board = self.board.with_cell(delta.cell, delta.symbol)
+        self.seq = delta.seq
+        return True
+
+
+class GameSession:
+    # One connection to the server, without any UI. Iterate over events() to play:
+    #
+    #     session = GameSession(host, port, "alice")
+    #     await session.connect()
+    #     async for event in session.events():
+    #         if isinstance(event, Turn) and event.mine:
+    #             session.move(session.board.free_cells()[0])
+    #
+    # Any number of sessions can share one event loop. PING is answered here, and a lost
+    # connection is resumed with the session token when the server still holds the seat.
+    # binary=True asks for the binary protocol, which is smaller and cheaper to parse.
+    def __init__(self, host, port, username, resume=True, binary=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.resume_enabled = resume
+        self.binary = binary
+        self.reader = None
+        self.writer = None
+        self.decoder = None  # BinaryDecoder of the current connection in binary mode
+        self.token = None
+        self.symbol = None
+        self.state = BoardState(lambda: self.send("BOARD"))
+        self.my_turn = False
+        self.opponent = None
+        self.stats = None
+        self.leaving = False
+
+    async def open(self, first_line):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=MAX_FRAME)
+        self.writer.write(encode(BINARY + first_line if self.binary else first_line))
+        response = decode(await self.reader.readline())
+        if response != CONNECTED:
+            self.writer.close()
+            raise HandshakeError(response)
+        self.decoder = BinaryDecoder() if self.binary else None
+
+    async def connect(self):
+        await self.open(self.username)
+
+    async def resume(self):
+        for _ in range(RESUME_ATTEMPTS):
+            await asyncio.sleep(RESUME_DELAY)
+            try:
+                await self.open(f"RESUME {self.token}")
+                return True
+            except HandshakeError:
+                return False  # the seat is gone
+            except OSError:
+                continue
+        return False
+
+    @property
+    def board(self):
+        return self.state.board
+
+    def apply(self, event):
+        # False for a delta that doesn't belong to the board we have, it isn't passed on
+        if isinstance(event, CellChanged):
+            return self.state.apply(event)
+        if isinstance(event, BoardChanged):
+            self.state.replace(event.board)
+        elif isinstance(event, Turn):
+            self.my_turn = event.mine
+            if not event.mine:
+                self.opponent = event.player
+        elif isinstance(event, SymbolAssigned):
+            self.symbol = event.symbol
+        elif isinstance(event, GameOver):
+            self.my_turn = False
+        elif isinstance(event, SessionStarted):
+            self.token = event.token
+        elif isinstance(event, Stats):
+            self.stats = event
+        elif isinstance(event, Resumed):
+            self.symbol = event.symbol
+            if event.board is not None:
+                self.state.replace(event.board)
+            self.my_turn = event.turn == event.symbol
+        return True
+
+    async def read_events(self):
+        # Events of what arrives next, None once the connection is gone
+        try:
+            if self.decoder is not None:
+                data = await self.reader.read(READ_SIZE)
+                return self.decoder.feed(data) if data else None
+            frame = await self.reader.readline()
+        except (ConnectionError, ValueError):
+            return None
+        if not frame.endswith(b"\n"):
+            return None
+        event = parse_message(decode(frame))
+        return [event] if event is not None else []
+
+    async def events(self):
+        while True:
+            events = await self.read_events()
+            if events is None:
+                if self.token and self.resume_enabled and not self.leaving and await self.resume():
+                    continue
+                yield Disconnected("connection closed" if self.leaving else "connection lost")
+                return
+            for event in events:
+                if not self.apply(event):
+                    continue
+                if isinstance(event, Ping):
+                    self.send("PONG")
+                    continue
+                yield event
+
+    def send(self, message):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(binary_command(message) if self.decoder is not None else encode(message))
+
+    def move(self, cell):
+        self.send(f"MOVE {cell}")
+
+    def spectate(self, room_id):
+        self.send(f"SPECTATE {room_id}")
+
+    def play(self):
+        self.send("PLAY")
+
+    def chat(self, text):
+        self.send(text)
+
+    def close(self):
+        self.leaving = True
+        if self.writer is not None and not self.writer.is_closing():
+            self.send("Disconnect")
+            self.writer.close()
+
+
+async def connect_all(sessions, concurrency=200):
+    # Batch mode: connects every session with at most `concurrency` handshakes in flight.
+    # Returns the connected sessions and the errors of the others.
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = []
+
+    async def connect(session):
+        async with semaphore:
+            try:
+                await session.connect()
+                return session
+            except OSError as e:
+                errors.append(e)
+
+    connected = await asyncio.gather(*(connect(session) for session in sessions))
+    return [session for session in connected if session is not None], errors
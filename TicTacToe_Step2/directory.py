@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import quote
+
+from matchmaking import Matchmaker
+from protocol import MAX_FRAME, decode, encode
+
+MATCH_INTERVAL = 1
+
+
+def room_channel(room_id):
+    return f"room.{room_id}"
+
+
+def node_channel(node):
+    return f"node.{node}"
+
+
+def chat_channel(room_id):
+    return f"chat.{room_id}"
+
+
+def player_channel(node, username):
+    # What a hosting node sends a player whose connection is on node
+    return f"player.{node}.{quote(username, safe='')}"
+
+
+class RoomDirectory:
+    # Which node hosts which room, publish/subscribe between nodes and the queue of players
+    # waiting on every node. The room table is replicated to every node, so lookup() never
+    # waits on the network.
+    def __init__(self):
+        self.rooms = {}
+        self.subscribers = {}  # channel -> callbacks of this node
+
+    async def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def lookup(self, room_id):
+        return self.rooms.get(room_id)
+
+    def register(self, room_id, node):
+        raise NotImplementedError
+
+    def unregister(self, room_id):
+        raise NotImplementedError
+
+    def publish(self, channel, data):
+        raise NotImplementedError
+
+    def queue(self, node, message):
+        # A change to the waiting players of node, as a SharedMatchmaker notifies it
+        raise NotImplementedError
+
+    def subscribe(self, channel, callback):
+        # True for the first subscriber of this node, which is when the backend has to know
+        callbacks = self.subscribers.setdefault(channel, [])
+        callbacks.append(callback)
+        return len(callbacks) == 1
+
+    def unsubscribe(self, channel, callback):
+        callbacks = self.subscribers.get(channel)
+        if not callbacks or callback not in callbacks:
+            return False
+        callbacks.remove(callback)
+        if callbacks:
+            return False
+        del self.subscribers[channel]
+        return True
+
+    def deliver(self, channel, data):
+        for callback in list(self.subscribers.get(channel, ())):
+            callback(data)
+
+
+class MatchQueue:
+    # Players waiting on every node, matched the way one server matches its own. The pair
+    # goes to the node of the player who waited longer, which hosts their room:
+    #   pair [<username>, <opponent>, <opponent's node>, <opponent's rating>]
+    def __init__(self, publish):
+        self.publish = publish
+        self.matchmaker = Matchmaker()  # keyed by (node, username), names are per node
+
+    def command(self, node, message):
+        command, _, username = message.partition(" ")
+        if command == "wait":
+            rating, _, username = username.partition(" ")
+            self.enqueue((node, username), int(rating))
+        elif command == "unwait":
+            self.dequeue((node, username))
+
+    def enqueue(self, player, rating):
+        self.dequeue(player)
+        self.matchmaker.ratings[player] = rating
+        opponent = self.matchmaker.enqueue(player, time.monotonic())
+        if opponent is not None:
+            self.pair(opponent, player)
+
+    def dequeue(self, player):
+        self.matchmaker.remove(player)
+        self.matchmaker.ratings.pop(player, None)
+
+    def drop(self, nodes):
+        # Those nodes are gone
+        for player in [player for player in self.matchmaker.waiting if player[0] in nodes]:
+            self.dequeue(player)
+
+    def pair(self, first, second):
+        rating = self.matchmaker.rating(second)
+        self.dequeue(first)
+        self.dequeue(second)
+        (node, username), (opponent_node, opponent) = first, second
+        self.publish(node_channel(node), f"pair {json.dumps([username, opponent, opponent_node, rating])}")
+
+    def match_waiting(self):
+        for first, second in self.matchmaker.match_waiting(time.monotonic()):
+            self.pair(first, second)
+
+
+async def match_waiting(queue):
+    # The rating windows of waiting players widen over time
+    while True:
+        await asyncio.sleep(MATCH_INTERVAL)
+        queue.match_waiting()
+
+
+class LocalHub:
+    # In-process stand-in for the broker, shared by every LocalDirectory of one process
+    def __init__(self):
+        self.rooms = {}
+        self.nodes = []
+        self.queue = MatchQueue(lambda channel, message: self.publish(channel, encode(message)))
+        self.match_task = None
+
+    def publish(self, channel, data):
+        # Delivered on the next loop iteration, like it would be coming from a broker
+        loop = asyncio.get_running_loop()
+        for node in self.nodes:
+            if channel in node.subscribers:
+                loop.call_soon(node.deliver, channel, data)
+
+
+class LocalDirectory(RoomDirectory):
+    def __init__(self, hub):
+        super().__init__()
+        self.hub = hub
+        self.rooms = hub.rooms
+        self.queued_nodes = set()
+        hub.nodes.append(self)
+
+    async def start(self):
+        if self.hub.match_task is None:
+            self.hub.match_task = asyncio.get_running_loop().create_task(match_waiting(self.hub.queue))
+
+    def close(self):
+        if self in self.hub.nodes:
+            self.hub.nodes.remove(self)
+        self.hub.queue.drop(self.queued_nodes)
+        if not self.hub.nodes and self.hub.match_task is not None:
+            self.hub.match_task.cancel()
+            self.hub.match_task = None
+
+    def register(self, room_id, node):
+        self.rooms[room_id] = node
+
+    def unregister(self, room_id):
+        self.rooms.pop(room_id, None)
+
+    def publish(self, channel, data):
+        self.hub.publish(channel, data)
+
+    def queue(self, node, message):
+        self.queued_nodes.add(node)
+        self.hub.queue.command(node, message)
+
+
+def parse_address(address):
+    if address.startswith("unix:"):
+        return address[len("unix:"):], None
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class BrokerDirectory(RoomDirectory):
+    # Client of a Broker, over TCP ("host:port") or a Unix socket ("unix:/path")
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+        self.writer = None
+        self.read_task = None
+
+    async def start(self):
+        path, port = parse_address(self.address)
+        if port is None:
+            reader, self.writer = await asyncio.open_unix_connection(path, limit=MAX_FRAME)
+        else:
+            reader, self.writer = await asyncio.open_connection(path, port, limit=MAX_FRAME)
+        self.read_task = asyncio.get_running_loop().create_task(self.read(reader))
+
+    def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def send(self, message):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(encode(message))
+
+    def register(self, room_id, node):
+        self.rooms[room_id] = node
+        self.send(f"SET {room_id} {node}")
+
+    def unregister(self, room_id):
+        self.rooms.pop(room_id, None)
+        self.send(f"DEL {room_id}")
+
+    def publish(self, channel, data):
+        self.send(f"PUB {channel} {decode(data)}")
+
+    def queue(self, node, message):
+        self.send(f"QUEUE {node} {message}")
+
+    def subscribe(self, channel, callback):
+        first = super().subscribe(channel, callback)
+        if first:
+            self.send(f"SUB {channel}")
+        return first
+
+    def unsubscribe(self, channel, callback):
+        last = super().unsubscribe(channel, callback)
+        if last:
+            self.send(f"UNSUB {channel}")
+        return last
+
+    async def read(self, reader):
+        while True:
+            try:
+                frame = await reader.readline()
+            except (ConnectionError, ValueError):
+                return
+            if not frame.endswith(b"\n"):
+                return
+            command, _, rest = decode(frame).partition(" ")
+            if command == "MSG":
+                channel, _, payload = rest.partition(" ")
+                self.deliver(channel, encode(payload))
+            elif command == "SET":
+                room_id, _, node = rest.partition(" ")
+                self.rooms[int(room_id)] = node
+            elif command == "DEL":
+                self.rooms.pop(int(rest), None)
+
+
+class Broker:
+    # Small stand-in for a real message broker: keeps the room table, tells every node
+    # about changes to it, relays published messages to the channel's subscribers and
+    # pairs the players waiting on every node
+    def __init__(self):
+        self.rooms = {}  # room id -> (node, writer of the node that registered it)
+        self.subscriptions = {}  # channel -> writers
+        self.writers = set()
+        self.queue = MatchQueue(self.publish)
+        self.queued_nodes = {}  # writer -> nodes whose players it queued
+        self.server = None
+        self.match_task = None
+
+    async def start(self, address):
+        path, port = parse_address(address)
+        if port is None:
+            self.server = await asyncio.start_unix_server(self.handle, path, limit=MAX_FRAME)
+        else:
+            self.server = await asyncio.start_server(self.handle, path, port, limit=MAX_FRAME)
+        self.match_task = asyncio.get_running_loop().create_task(match_waiting(self.queue))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.match_task is not None:
+            self.match_task.cancel()
+
+    def broadcast(self, message):
+        frame = encode(message)
+        for writer in self.writers:
+            writer.write(frame)
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        for room_id, (node, _) in self.rooms.items():
+            writer.write(encode(f"SET {room_id} {node}"))
+        try:
+            while True:
+                frame = await reader.readline()
+                if not frame.endswith(b"\n"):
+                    break
+                self.dispatch(writer, decode(frame))
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            for writers in self.subscriptions.values():
+                writers.discard(writer)
+            for room_id in [room_id for room_id, (_, owner) in self.rooms.items() if owner is writer]:
+                del self.rooms[room_id]
+                self.broadcast(f"DEL {room_id}")
+            self.queue.drop(self.queued_nodes.pop(writer, ()))
+            writer.close()
+
+    def publish(self, channel, payload):
+        frame = encode(f"MSG {channel} {payload}")
+        for subscriber in self.subscriptions.get(channel, ()):
+            subscriber.write(frame)
+
+    def dispatch(self, writer, message):
+        command, _, rest = message.partition(" ")
+        if command == "PUB":
+            channel, _, payload = rest.partition(" ")
+            self.publish(channel, payload)
+        elif command == "SUB":
+            self.subscriptions.setdefault(rest, set()).add(writer)
+        elif command == "UNSUB":
+            subscribers = self.subscriptions.get(rest)
+            if subscribers is not None:
+                subscribers.discard(writer)
+                if not subscribers:
+                    del self.subscriptions[rest]
+        elif command == "SET":
+            room_id, _, node = rest.partition(" ")
+            self.rooms[room_id] = (node, writer)
+            self.broadcast(message)
+        elif command == "DEL":
+            if self.rooms.get(rest, (None, None))[1] is writer:
+                del self.rooms[rest]
+                self.broadcast(message)
+        elif command == "QUEUE":
+            node, _, message = rest.partition(" ")
+            self.queued_nodes.setdefault(writer, set()).add(node)
+            self.queue.command(node, message)
+
+
+async def run_broker(address):
+    broker = Broker()
+    await broker.start(address)
+    print(f"Broker listening on {address}", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in broker for the room directory")
+    parser.add_argument("address", help="host:port or unix:/path")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_broker(args.address))
+    except KeyboardInterrupt:
+        pass
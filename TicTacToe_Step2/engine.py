@@ -0,0 +1,716 @@
+import argparse
+import asyncio
+import os
+import secrets
+import socket
+from collections import deque
+
+from directory import BrokerDirectory, node_channel
+from eventlog import LEVELS, LogPipeline
+from game import BOARD_FRAMES, CELL_FRAME
+from matchmaking import SharedMatchmaker
+from metrics import Counter, EngineMetrics, serve_metrics
+from replay import ReplayLog
+from stats import StatsStore
+from timerwheel import TimerWheel
+from protocol import (BINARY, MAX_FRAME, OP_MOVE, OP_PING, OP_PONG, OP_TEXT, U16, binary_frame, decode, encode,
+                      is_binary_board, is_binary_cell, is_turn_message, names_frame, text_frame)
+from ratelimit import TokenBucket
+from rooms import RoomManager
+
+WRITE_BUFFER_HIGH = 16 * 1024
+MATCHMAKING_INTERVAL = 1
+HANDSHAKE_TIMEOUT = 10
+DETACH_TIMEOUT = 5  # seconds a connection being handed over has to take what is queued for it
+DETACH_POLL = 0.01
+CHAT_QUEUE = 64  # chat lines waiting for a connection, the oldest are dropped beyond that
+BOARD_UPDATES = BOARD_FRAMES + (CELL_FRAME,)
+PING = encode("PING")
+PONG = encode("PONG")
+
+
+class ServerObserver:
+    # Hooks the engine calls whenever its state changes. The Tk window subclasses this,
+    # logs go through the engine's LogPipeline instead.
+    def on_started(self, port):
+        pass
+
+    def on_stopped(self):
+        pass
+
+    def on_room_changed(self, room_id, players, spectators):
+        pass
+
+    def on_room_closed(self, room_id):
+        pass
+
+    def on_board_changed(self, room_id, game):
+        # Called on every move, so the board is only rendered by observers that show it
+        pass
+
+    def on_games_played(self, games_played):
+        pass
+
+    def on_client_joined(self, username):
+        pass
+
+    def on_client_left(self, username):
+        pass
+
+    def on_session_started(self, username, token):
+        pass
+
+    def on_client_rejected(self, username):
+        pass
+
+
+class Connection:
+    # Socket-like wrapper around an asyncio stream so TicTacToeGame can keep calling send().
+    # send() only queues the frame, a writer task drains the queue at the pace the peer reads.
+    # The task runs once the current tick is over, so every frame queued for the connection
+    # during the tick goes out in a single write.
+    def __init__(self, reader, writer, max_queue=256, slow_consumer="coalesce", metrics=None):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.max_queue = max_queue
+        self.slow_consumer = slow_consumer
+        self.bytes_sent = metrics.bytes_sent if metrics else Counter("bytes_sent", "")
+        self.frames_sent = metrics.frames_sent if metrics else Counter("frames_sent", "")
+        self.socket_writes = metrics.socket_writes if metrics else Counter("socket_writes", "")
+        self.queue = deque()
+        self.chat = deque(maxlen=CHAT_QUEUE)  # only written once no game frame is waiting
+        self.last_seen = 0  # wheel tick of the last message from the peer
+        self.names = None  # username -> id sent to the peer, once it speaks the binary protocol
+        self.closing = False
+        self.task = asyncio.current_task()  # the one serving the peer, cancelled by detach()
+        self.wakeup = asyncio.Event()
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.writer_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def send(self, data):
+        if self.closing:
+            return
+        if len(self.queue) >= self.max_queue and not self.make_room(data):
+            self.abort()
+            return
+        if self.names is not None:
+            data = names_frame(data, self.names) or binary_frame(data)
+        self.queue.append(data)
+        self.wakeup.set()
+
+    def send_chat(self, data):
+        # Chat never counts against max_queue: a flood only pushes out older chat lines
+        if self.closing:
+            return
+        self.chat.append(text_frame(data) if self.names is not None else data)
+        self.wakeup.set()
+
+    def make_room(self, data):
+        # Only board updates and turn announcements can be skipped. A board replaces every
+        # update before it, a client missing CELL deltas sees the gap in their numbers and
+        # asks for the board, and the next move brings a newer announcement anyway.
+        if self.slow_consumer != "coalesce" or not (data.startswith(BOARD_UPDATES) or is_turn_message(data)):
+            return False
+        board = data.startswith(BOARD_FRAMES)
+        if self.names is not None:
+            self.queue = deque(frame for frame in self.queue
+                               if not (is_binary_cell(frame) or is_turn_message(frame)
+                                       or board and is_binary_board(frame)))
+        else:
+            self.queue = deque(frame for frame in self.queue
+                               if not (frame.startswith(CELL_FRAME) or is_turn_message(frame)
+                                       or board and frame.startswith(BOARD_FRAMES)))
+        return len(self.queue) < self.max_queue
+
+    async def detach(self):
+        # Stops reading and writes out what is queued, then returns a duplicate of the socket
+        # and the bytes read from it that were not handled yet. The caller has cancelled the
+        # task reading from it. None when the peer doesn't take the queued frames in time.
+        transport = self.writer.transport
+        transport.pause_reading()
+        self.reader.feed_eof()
+        try:
+            data = await self.reader.read()
+        except ConnectionError:
+            self.abort()
+            return None
+        deadline = asyncio.get_running_loop().time() + DETACH_TIMEOUT
+        while self.queue or self.chat or transport.get_write_buffer_size():
+            if transport.is_closing() or asyncio.get_running_loop().time() > deadline:
+                self.abort()
+                return None
+            await asyncio.sleep(DETACH_POLL)
+        sock = transport.get_extra_info("socket").dup()
+        self.abort()
+        return sock, data
+
+    def use_binary(self):
+        # Everything sent and received from now on is in the binary protocol
+        self.names = {}
+
+    async def flush(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue or self.chat:
+                    if self.queue:
+                        frames = list(self.queue)
+                        self.queue.clear()
+                    else:
+                        frames = list(self.chat)
+                        self.chat.clear()
+                    # One send for the whole batch (sendmsg on Python 3.12+, a joined buffer before)
+                    self.writer.writelines(frames)
+                    self.bytes_sent.inc(sum(map(len, frames)))
+                    self.frames_sent.inc(len(frames))
+                    self.socket_writes.inc()
+                    await self.writer.drain()
+                if self.closing:
+                    self.writer.close()
+                    return
+        except ConnectionError:
+            self.writer.transport.abort()
+
+    async def recv(self):
+        # One message per call, None once the peer is gone
+        if self.names is not None:
+            return await self.recv_binary()
+        try:
+            frame = await self.reader.readline()
+        except (ConnectionError, ValueError):
+            return None
+        if not frame.endswith(b"\n"):
+            return None
+        return decode(frame)
+
+    async def recv_binary(self):
+        # Binary frames come back as the message of the text protocol, an unknown opcode
+        # ends the connection like a broken frame does
+        try:
+            opcode = (await self.reader.readexactly(1))[0]
+            if opcode == OP_MOVE:
+                cell, = U16.unpack(await self.reader.readexactly(2))
+                return f"MOVE {cell}"
+            if opcode == OP_PONG:
+                return "PONG"
+            if opcode == OP_PING:
+                return "PING"
+            if opcode == OP_TEXT:
+                length, = U16.unpack(await self.reader.readexactly(2))
+                return decode(await self.reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        return None
+
+    def close(self):
+        # Anything already queued is still delivered before the socket closes
+        self.closing = True
+        self.wakeup.set()
+
+    def abort(self):
+        self.closing = True
+        self.queue.clear()
+        self.chat.clear()
+        self.writer_task.cancel()
+        self.writer.transport.abort()
+
+
+class GameServer:
+    def __init__(self, observer=None, max_clients=None, max_queue=256, slow_consumer="coalesce", bot_after=5,
+                 first_room_id=1, room_id_step=1, directory=None, broker=None, node=None, logs=None,
+                 metrics_port=None, replays=None, stats=None, resume_grace=30, ping_interval=15, idle_timeout=45,
+                 turn_timeout=60, board_size=3, win_length=3, chat_history=50, chat_rate=1, chat_burst=5):
+        self.observer = observer or ServerObserver()
+        self.logs = logs or LogPipeline()
+        # Rooms of other nodes are found through the directory, None runs a single node
+        self.directory = directory or (BrokerDirectory(broker) if broker else None)
+        self.node = node or f"{socket.gethostname()}-{os.getpid()}"
+        self.max_clients = max_clients
+        self.max_queue = max_queue
+        self.slow_consumer = slow_consumer
+        self.clients = {}
+        self.rooms = RoomManager(self, bot_after=bot_after, first_room_id=first_room_id,
+                                 room_id_step=room_id_step)
+        self.metrics = EngineMetrics(self)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.replays = replays  # ReplayLog of finished games, None to keep none
+        self.stats = stats  # StatsStore of every player, None to keep ratings in memory only
+        # A player who loses their connection mid-game keeps the seat this many seconds
+        self.resume_grace = resume_grace
+        self.sessions = {}  # token -> username
+        self.tokens = {}  # username -> token
+        self.held = {}  # username -> timer releasing the seat
+        # Silent connections get a PING after ping_interval seconds and are dropped after
+        # idle_timeout; a player who doesn't move within turn_timeout is removed. 0 disables.
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.turn_timeout = turn_timeout
+        self.wheel = TimerWheel()
+        # Every room plays on a board_size x board_size board, won with win_length in a row
+        self.board_size = board_size
+        self.win_length = win_length
+        # Every room keeps its last chat_history lines for newcomers; a user may say
+        # chat_rate lines per second on average, chat_burst in a row
+        self.chat_history = chat_history
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}  # username -> TokenBucket
+        self.games_played = 0
+        self.server = None
+        self.loop = None
+        self.closed = None
+        self.background_tasks = []
+
+    def log(self, message, level="info", **fields):
+        self.logs.record(level, message, **fields)
+
+    def game_finished(self):
+        self.games_played += 1
+        self.observer.on_games_played(self.games_played)
+
+    def send_queue_depths(self):
+        return [len(client.queue) for username, client in self.clients.items() if username not in self.rooms.bots]
+
+    async def run(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.closed = asyncio.Event()
+        await self.start_directory()
+        try:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_FRAME)
+        except OSError as e:
+            self.log(f"Failed to start server: {str(e)}", "error")
+            self.logs.close()
+            return
+        self.log(f"Server started on port {port}")
+        self.observer.on_started(port)
+        await self.serve()
+
+    async def serve(self):
+        # Runs until stop(). run() calls it once it is listening, a worker process calls it
+        # directly and hands connections over through adopt().
+        self.loop = asyncio.get_running_loop()
+        if self.closed is None:
+            self.closed = asyncio.Event()
+        self.logs.start()
+        if self.replays is not None:
+            self.replays.start()
+        if self.stats is not None:
+            self.stats.start(self.log)
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = await serve_metrics(self.metrics, "127.0.0.1", self.metrics_port)
+                self.log(f"Metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+            except OSError as e:
+                self.log(f"Failed to serve metrics: {str(e)}", "warning")
+        self.observer.on_games_played(self.games_played)
+        self.background_tasks.append(self.loop.create_task(self.matchmaking()))
+        self.background_tasks.append(self.loop.create_task(self.wheel.run()))
+        await self.closed.wait()
+
+    async def start_directory(self):
+        if self.directory is None:
+            return
+        try:
+            await self.directory.start()
+        except OSError as e:
+            self.log(f"Failed to reach the room directory, running on this node only: {str(e)}", "warning")
+            self.directory = None
+            return
+        self.directory.subscribe(node_channel(self.node), self.rooms.node_message)
+        if not isinstance(self.rooms.matchmaker, SharedMatchmaker):
+            # Players wait with those of every node, unless a supervisor already pairs them
+            self.rooms.matchmaker = SharedMatchmaker(lambda message: self.directory.queue(self.node, message))
+            self.rooms.remote_seats = True
+        self.log(f"Joined the room directory as {self.node}")
+
+    async def adopt(self, sock, data):
+        # Serves a socket accepted by another process, data is what was already read from it
+        reader, writer = await self.open_socket(sock, data)
+        await self.handle_connection(reader, writer)
+
+    async def adopt_player(self, sock, data, state, then):
+        # Serves a player another worker handed over with detach(); then(username) runs once
+        # they are registered here, to seat them
+        reader, writer = await self.open_socket(sock, data)
+        client = Connection(reader, writer, self.max_queue, self.slow_consumer, self.metrics)
+        username = state["username"]
+        if username in self.clients:
+            client.abort()
+            return
+        self.clients[username] = client
+        if state["binary"]:
+            client.use_binary()
+        self.rooms.matchmaker.ratings[username] = state["rating"]
+        self.sessions[state["token"]] = username
+        self.tokens[username] = state["token"]
+        self.observer.on_client_joined(username)
+        self.observer.on_session_started(username, state["token"])
+        self.log(f"{username} was handed over", "debug")
+        self.watch_connection(client, username)
+        then(username)
+        await self.handle_client(client, username)
+
+    async def open_socket(self, sock, data):
+        reader = asyncio.StreamReader(limit=MAX_FRAME)
+        reader.feed_data(data)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await self.loop.connect_accepted_socket(lambda: protocol, sock)
+        return reader, asyncio.StreamWriter(transport, protocol, reader, self.loop)
+
+    async def detach(self, username):
+        # Takes a player who waits for an opponent off this worker so another one can seat
+        # them: returns (socket, bytes not handled yet, state for adopt_player), or None when
+        # the connection can't be handed over. Once the connection is taken apart the player
+        # is forgotten here, even if it then turns out to be lost.
+        client = self.clients.get(username)
+        if client is None or client.closing or client.task is None or client.task.done():
+            return None
+        if username in self.rooms.room_of or username in self.held:
+            return None
+        client.task.cancel()
+        await asyncio.wait([client.task])
+        state = {"username": username, "token": self.tokens.get(username), "binary": client.names is not None,
+                 "rating": self.rooms.matchmaker.rating(username)}
+        detached = await client.detach()
+        self.forget_client(client, username)
+        if detached is None:
+            self.log(f"{username} lost connection while being handed over")
+            return None
+        sock, data = detached
+        return sock, data, state
+
+    async def matchmaking(self):
+        while True:
+            await asyncio.sleep(MATCHMAKING_INTERVAL)
+            self.rooms.match_waiting()
+
+    def stop(self):
+        for client in self.clients.values():
+            client.send(encode("MESSAGE Server has disconnected."))
+            client.close()
+        self.clients.clear()
+        for timer in self.held.values():
+            timer.cancel()
+        self.held.clear()
+        self.sessions.clear()
+        self.tokens.clear()
+        for room_id in list(self.rooms.rooms):
+            self.observer.on_room_closed(room_id)
+        self.rooms.clear()
+        if self.directory is not None:
+            self.directory.close()
+        self.games_played = 0
+        for task in self.background_tasks:
+            task.cancel()
+        self.background_tasks.clear()
+        if self.server:
+            self.server.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+        self.log("Server stopped")
+        self.close_stores()
+        self.observer.on_stopped()
+        self.closed.set()
+
+    def close_stores(self):
+        # Writes out whatever the background writers still hold
+        if self.replays is not None:
+            self.replays.close()
+        if self.stats is not None:
+            self.stats.close()
+        self.logs.close()
+
+    async def handle_connection(self, reader, writer):
+        client = Connection(reader, writer, self.max_queue, self.slow_consumer, self.metrics)
+        timer = self.wheel.schedule(HANDSHAKE_TIMEOUT, client.abort)
+        username = await client.recv()
+        timer.cancel()
+        if not username:
+            client.close()
+            return
+
+        binary = username.startswith(BINARY)
+        if binary:
+            username = username[len(BINARY):]
+        if username.startswith("RESUME "):
+            token = username[len("RESUME "):]
+            if not token:
+                client.close()
+                return
+            await self.resume(client, token, binary)
+            return
+        if not username:
+            # "BINARY " on its own
+            client.close()
+            return
+
+        if self.max_clients is not None and len(self.clients) >= self.max_clients:
+            client.send(encode("MESSAGE Server is full"))
+            client.close()
+            if username not in self.clients:
+                self.observer.on_client_rejected(username)
+            return
+
+        if username in self.clients:
+            client.send(encode("MESSAGE Username already taken"))
+            client.close()
+            return
+
+        self.clients[username] = client
+        self.metrics.connections.inc()
+        client.send(encode("MESSAGE Connected to the server"))
+        if binary:
+            client.use_binary()
+        self.log(f"{username} connected.")
+        self.observer.on_client_joined(username)
+        self.watch_connection(client, username)
+
+        token = secrets.token_urlsafe(12)
+        self.sessions[token] = username
+        self.tokens[username] = token
+        client.send(encode(f"SESSION {token}"))
+        self.observer.on_session_started(username, token)
+
+        if self.stats is not None:
+            stats = await self.stats.load(username)
+            self.rooms.matchmaker.ratings[username] = stats.rating
+            client.send(encode(f"STATS {stats.wins} {stats.losses} {stats.draws} {stats.rating}"))
+
+        self.rooms.join_as_player(username)
+        await self.handle_client(client, username)
+
+    async def handle_client(self, client, username):
+        while True:
+            message = await client.recv()
+            client.last_seen = self.wheel.current
+            if message is None:
+                if self.clients.get(username) is client and not self.hold_seat(client, username):
+                    self.log(f"{username} lost connection")
+                    self.remove_client(client, username)
+                client.close()
+                return
+            if message.startswith("MOVE"):
+                try:
+                    cell = int(message.split()[1])
+                except (IndexError, ValueError):
+                    self.metrics.invalid_moves.inc()
+                    client.send(encode("INVALID_MOVE"))
+                    continue
+                room = self.rooms.room_of.get(username)
+                if room is None:
+                    self.metrics.invalid_moves.inc()
+                    client.send(encode("INVALID_MOVE"))
+                    continue
+                room.submit(room.handle_move, client, username, cell)
+            elif message == "BOARD":
+                room = self.rooms.room_of.get(username)
+                if room is not None:
+                    room.submit(room.send_board, client)
+            elif message.startswith("SPECTATE"):
+                self.spectate(client, username, message)
+            elif message == "PLAY":
+                self.rooms.leave(username, then=lambda: self.rooms.join_as_player(username))
+            elif message == "PONG":
+                pass
+            elif message == "PING":
+                client.send(PONG)
+            elif message == "Disconnect":
+                self.log(f"{username} disconnected")
+                self.remove_client(client, username)
+                client.close()
+                return
+            else:
+                self.chat(client, username, message)
+
+    def chat(self, client, username, message):
+        bucket = self.chat_buckets.get(username)
+        if bucket is None:
+            bucket = self.chat_buckets[username] = TokenBucket(self.chat_rate, self.chat_burst)
+        if not bucket.take():
+            self.metrics.chat_limited.inc()
+            client.send(encode("MESSAGE You are sending messages too fast"))
+            return
+        room = self.rooms.room_of.get(username)
+        if room is None:
+            client.send(encode("MESSAGE Join a room to chat"))
+            return
+        self.metrics.chat_messages.inc()
+        room.submit(room.chat, f"{username}: {message}")
+
+    def watch_connection(self, client, username):
+        client.last_seen = self.wheel.current
+        if self.ping_interval:
+            self.wheel.schedule(self.ping_interval, self.check_alive, client, username)
+
+    def check_alive(self, client, username):
+        # Any message counts as a sign of life, PING is only sent to silent connections
+        if self.clients.get(username) is not client or client.closing:
+            return
+        idle = (self.wheel.current - client.last_seen) * self.wheel.tick
+        if self.idle_timeout and idle >= self.idle_timeout:
+            self.metrics.idle_timeouts.inc()
+            self.log(f"{username} has been silent for {idle:.0f} seconds", "warning")
+            client.abort()  # handled like any lost connection, the seat may still be held
+            return
+        if idle >= self.ping_interval:
+            client.send(PING)
+        self.wheel.schedule(self.ping_interval, self.check_alive, client, username)
+
+    def evict(self, username, reason):
+        client = self.clients.get(username)
+        if client is None:
+            return
+        timer = self.held.pop(username, None)
+        if timer is not None:
+            timer.cancel()
+        self.log(f"{username} removed: {reason}", "warning")
+        client.send(encode(f"MESSAGE {reason}"))
+        self.remove_client(client, username)
+        client.close()
+
+    def hold_seat(self, client, username):
+        # Only a player in a running game waits for their connection to come back
+        room = self.rooms.room_of.get(username)
+        if not self.resume_grace or room is None or not room.holds_seat(username):
+            return False
+        self.log(f"{username} lost connection, holding their seat for {self.resume_grace} seconds")
+        self.held[username] = self.loop.call_later(self.resume_grace, self.release_seat, client, username)
+        room.submit(room.player_away, username)
+        return True
+
+    def release_seat(self, client, username):
+        del self.held[username]
+        if self.clients.get(username) is client:
+            self.log(f"{username} did not come back")
+            self.remove_client(client, username)
+
+    async def resume(self, client, token, binary=False):
+        username = self.sessions.get(token)
+        if username is None or username not in self.clients:
+            client.send(encode("MESSAGE Session expired"))
+            client.close()
+            return
+        timer = self.held.pop(username, None)
+        if timer is not None:
+            timer.cancel()
+        else:
+            # The old connection is not known to be dead yet, the new one takes over
+            self.clients[username].abort()
+        self.clients[username] = client
+        client.send(encode("MESSAGE Connected to the server"))
+        if binary:
+            client.use_binary()
+        self.log(f"{username} resumed their session")
+        self.watch_connection(client, username)
+        room = self.rooms.room_of.get(username)
+        if room is not None:
+            room.submit(room.resume, username, client)
+        await self.handle_client(client, username)
+
+    def spectate(self, client, username, message):
+        try:
+            room = self.rooms.get(int(message.split()[1]))
+        except (IndexError, ValueError):
+            room = None
+        if room is None:
+            client.send(encode("MESSAGE No such room\n"))
+            return
+        if self.rooms.room_of.get(username) is room:
+            return
+        self.rooms.leave(username, then=lambda: self.rooms.join_as_spectator(username, room))
+
+    def remove_client(self, client, username):
+        self.rooms.leave(username, then=lambda: self.forget_client(client, username))
+
+    def forget_client(self, client, username):
+        if self.clients.get(username) is client:
+            del self.clients[username]
+            self.sessions.pop(self.tokens.pop(username, None), None)
+            self.chat_buckets.pop(username, None)
+            self.rooms.forget(username)
+            if self.stats is not None:
+                # The store has the rating now, only connected players are kept in memory
+                self.rooms.matchmaker.ratings.pop(username, None)
+            self.observer.on_client_left(username)
+
+
+def add_engine_arguments(parser):
+    parser.add_argument("--max-clients", type=int, default=None)
+    parser.add_argument("--max-queue", type=int, default=256,
+                        help="frames queued for a client before the slow consumer policy applies")
+    parser.add_argument("--slow-consumer", choices=["coalesce", "disconnect"], default="coalesce")
+    parser.add_argument("--bot-after", type=float, default=5,
+                        help="seconds a player waits for an opponent before playing the AI")
+    parser.add_argument("--no-bots", action="store_true", help="never pair players with the AI")
+    parser.add_argument("--broker", default=None,
+                        help="host:port or unix:/path of the room directory broker shared by all nodes")
+    parser.add_argument("--node", default=None, help="name of this node in the room directory")
+    parser.add_argument("--node-index", type=int, default=0, help="index of this node, for unique room ids")
+    parser.add_argument("--nodes", type=int, default=1, help="number of nodes sharing the broker")
+    parser.add_argument("--log-file", default=None, help="also write the log there as JSON lines")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info")
+    parser.add_argument("--replay-dir", default=None, help="keep every game in segment files there")
+    parser.add_argument("--resume-grace", type=float, default=30,
+                        help="seconds a disconnected player's seat is held for them, 0 to forfeit right away")
+    parser.add_argument("--ping-interval", type=float, default=15,
+                        help="seconds of silence before a client is sent PING, 0 for never")
+    parser.add_argument("--idle-timeout", type=float, default=45,
+                        help="seconds of silence before a client is dropped, 0 for never")
+    parser.add_argument("--turn-timeout", type=float, default=60,
+                        help="seconds a player has for a move before being removed, 0 for no limit")
+    parser.add_argument("--board-size", type=int, default=3, help="play on N x N boards")
+    parser.add_argument("--win-length", type=int, default=None,
+                        help="marks in a row that win, 3 on a 3x3 board and 5 on larger ones by default")
+    parser.add_argument("--chat-history", type=int, default=50, help="chat lines a room replays to newcomers")
+    parser.add_argument("--chat-rate", type=float, default=1, help="chat lines per second a user may send")
+    parser.add_argument("--chat-burst", type=int, default=5, help="chat lines a user may send in a row")
+    parser.add_argument("--stats-db", default=None, help="SQLite file keeping every player's results and rating")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on 127.0.0.1:<port>/metrics")
+
+
+def engine_options(args, parser):
+    win_length = args.win_length or (3 if args.board_size == 3 else min(args.board_size, 5))
+    if not 2 <= win_length <= args.board_size:
+        parser.error(f"--win-length must be between 2 and the board size, {args.board_size}")
+    return {
+        "max_clients": args.max_clients,
+        "max_queue": args.max_queue,
+        "slow_consumer": args.slow_consumer,
+        "bot_after": None if args.no_bots else args.bot_after,
+        "broker": args.broker,
+        "node": args.node,
+        "first_room_id": args.node_index + 1,
+        "room_id_step": args.nodes,
+        "logs": LogPipeline(args.log_file, args.log_level),
+        "metrics_port": args.metrics_port,
+        "replays": ReplayLog(args.replay_dir) if args.replay_dir else None,
+        "stats": StatsStore(args.stats_db) if args.stats_db else None,
+        "resume_grace": args.resume_grace,
+        "ping_interval": args.ping_interval,
+        "idle_timeout": args.idle_timeout,
+        "turn_timeout": args.turn_timeout,
+        "chat_history": args.chat_history,
+        "chat_rate": args.chat_rate,
+        "chat_burst": args.chat_burst,
+        "board_size": args.board_size,
+        "win_length": win_length,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless TicTacToe server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, required=True)
+    add_engine_arguments(parser)
+    args = parser.parse_args()
+
+    engine = GameServer(**engine_options(args, parser))
+    try:
+        asyncio.run(engine.run(args.host, args.port))
+    except KeyboardInterrupt:
+        engine.close_stores()
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+FLUSH_INTERVAL = 0.25
+
+
+class LogPipeline:
+    # Structured log of the engine. record() only appends to memory, a task hands the
+    # records over in batches to a helper thread that writes them as JSON lines to the log
+    # file and as text to the console. Memory stays bounded: the ring keeps the latest
+    # records for the GUI, and records over max_rate per second or max_pending unwritten
+    # ones are dropped and counted.
+    def __init__(self, path=None, level="info", console=True, capacity=1000, max_pending=10000,
+                 max_rate=2000):
+        self.path = path
+        self.level = LEVELS[level]
+        self.console = console
+        self.fields = {}  # added to every record, e.g. the worker index
+        self.ring = deque(maxlen=capacity)
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.max_rate = max_rate
+        self.seq = 0
+        self.second = 0
+        self.in_second = 0
+        self.dropped = 0
+        self.task = None
+        self.executor = None
+        self.file = None
+
+    def record(self, level, message, **fields):
+        if LEVELS[level] < self.level:
+            return
+        now = time.time()
+        second = int(now)
+        if second != self.second:
+            self.second = second
+            self.in_second = 0
+        self.in_second += 1
+        if self.in_second > self.max_rate or len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.seq += 1
+        entry = (self.seq, now, level, message, fields)
+        self.ring.append(entry)
+        if self.console or self.path:
+            self.pending.append(entry)
+
+    def tail(self, after):
+        # Records newer than sequence number after, at most the ring's capacity
+        entries = list(self.ring)
+        if not entries:
+            return []
+        return entries[max(0, len(entries) - (entries[-1][0] - after)):]
+
+    def format(self, entry):
+        _, _, level, message, fields = entry
+        prefix = "".join(f"[{key} {value}] " for key, value in {**self.fields, **fields}.items())
+        if level != "info":
+            prefix += f"{level.upper()}: "
+        return prefix + message.rstrip("\n")
+
+    def to_json(self, entry):
+        _, now, level, message, fields = entry
+        return json.dumps({"ts": round(now, 3), "level": level, "msg": message.rstrip("\n"),
+                           **self.fields, **fields})
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            batch = self.take()
+            if batch:
+                await loop.run_in_executor(self.executor, self.write, batch)
+
+    def take(self):
+        if self.dropped:
+            self.seq += 1
+            entry = (self.seq, time.time(), "warning", f"{self.dropped} log records dropped", {})
+            self.dropped = 0
+            self.ring.append(entry)
+            self.pending.append(entry)
+        # popleft rather than copy and clear, the GUI thread may be adding a record
+        return [self.pending.popleft() for _ in range(len(self.pending))]
+
+    def write(self, batch):
+        try:
+            if self.console:
+                sys.stdout.write("".join(self.format(entry) + "\n" for entry in batch))
+                sys.stdout.flush()
+            if self.path:
+                if self.file is None:
+                    self.file = open(self.path, "a", encoding="utf-8")
+                self.file.write("".join(self.to_json(entry) + "\n" for entry in batch))
+                self.file.flush()
+        except OSError:
+            pass  # a full disk or a closed console must not take the server down
+
+    def close(self):
+        # Writes out whatever is still pending, from the calling thread
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.write(self.take())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,194 @@
+from protocol import encode
+
+
+# Cell n (1-9) is bit n - 1 of a player's bitboard
+WIN_MASKS = tuple(sum(1 << (cell - 1) for cell in line) for line in (
+    (1, 2, 3), (4, 5, 6), (7, 8, 9),
+    (1, 4, 7), (2, 5, 8), (3, 6, 9),
+    (1, 5, 9), (3, 5, 7)
+))
+FULL_BOARD = 0b111111111
+# IS_WIN[bits] is 1 when a player holding the cells in bits has three in a row
+IS_WIN = bytes(any(bits & mask == mask for mask in WIN_MASKS) for bits in range(512))
+
+
+class TicTacToeGame:
+    __slots__ = ("players", "spectators", "x_bits", "o_bits", "turn", "moves", "_board_frame")
+    size = 3
+    win_length = 3
+
+    def __init__(self, players, spectators):
+        self.players = players
+        self.spectators = spectators
+        self.x_bits = 0
+        self.o_bits = 0
+        self.turn = 'X'
+        self.moves = bytearray()  # cells in the order they were played, for the replay log
+        self._board_frame = None
+
+    def cell(self, cell):
+        bit = 1 << (cell - 1)
+        if self.x_bits & bit:
+            return 'X'
+        if self.o_bits & bit:
+            return 'O'
+        return str(cell)
+
+    def board_repr(self):
+        return "{}|{}|{}\n{}|{}|{}\n{}|{}|{}".format(*[self.cell(cell) for cell in range(1, 10)])
+
+    def board_frame(self):
+        # The encoded BOARD message is shared by every receiver until the next move
+        if self._board_frame is None:
+            self._board_frame = encode(f"BOARD {self.board_repr()}")
+        return self._board_frame
+
+    def broadcast(self, frame):
+        for client_socket, _ in self.players.values():
+            client_socket.send(frame)
+        for client_socket, in self.spectators.values():
+            client_socket.send(frame)
+
+    def broadcast_board(self):
+        self.broadcast(self.board_frame())
+
+    def broadcast_cell(self, cell, symbol):
+        # Everyone already has the board before this move, so only the new cell is sent,
+        # numbered with the move. A snapshot is numbered with the marks on its board.
+        self.broadcast(encode(f"CELL {len(self.moves)} {cell} {symbol}"))
+
+    def add_spectator(self, username, client_socket):
+        self.spectators[username] = (client_socket,)
+        client_socket.send(self.board_frame())
+
+    def make_move(self, cell, symbol):
+        game_status = ["continue", None, None]
+
+        if not 1 <= cell <= 9:
+            return False, game_status
+        bit = 1 << (cell - 1)
+        if (self.x_bits | self.o_bits) & bit:
+            return False, game_status
+
+        if symbol == 'X':
+            self.x_bits |= bit
+            bits = self.x_bits
+        else:
+            self.o_bits |= bit
+            bits = self.o_bits
+        self.moves.append(cell)
+        self._board_frame = None
+
+        if IS_WIN[bits]:
+            game_status = ["end", "win", symbol]
+        elif self.check_draw():
+            game_status = ["end", "draw", None]
+        else:
+            self.turn = 'O' if self.turn == 'X' else 'X'
+
+        return True, game_status
+
+    def check_win(self):
+        if IS_WIN[self.x_bits]:
+            return 'X'
+        if IS_WIN[self.o_bits]:
+            return 'O'
+        return None
+
+    def check_draw(self):
+        return self.x_bits | self.o_bits == FULL_BOARD
+
+    def get_opponent_username(self, username):
+        for opponent_username, (_, player_symbol) in self.players.items():
+            if opponent_username != username:
+                return opponent_username
+
+
+# Frames holding a whole board, a newer one replaces any older one
+BOARD_FRAMES = (b"BOARD ", b"GRID ")
+CELL_FRAME = b"CELL "
+# Directions of the four lines through a cell: row, column and both diagonals
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+class KInARowGame(TicTacToeGame):
+    # size x size board won with win_length in a row, e.g. 15 and 5 for Gomoku. Only the
+    # occupied cells are stored, a move only looks at the four lines through it, and the
+    # GRID message lists the occupied cells in the order they were played:
+    #   GRID <size> <win_length> <cell><symbol> <cell><symbol> ...
+    __slots__ = ("size", "win_length", "cells", "grid", "played")
+
+    def __init__(self, players, spectators, size=15, win_length=5):
+        super().__init__(players, spectators)
+        self.size = size
+        self.win_length = win_length
+        self.cells = {}  # cell (1 to size * size) -> 'X' or 'O'
+        self.moves = []
+        # Text board for the observer, one byte changes per move
+        self.grid = bytearray((b"." * size + b"\n") * size)[:-1]
+        self.played = []  # "<cell><symbol>" of every move, for the GRID message
+
+    def cell(self, cell):
+        return self.cells.get(cell, str(cell))
+
+    def board_repr(self):
+        return self.grid.decode()
+
+    def board_frame(self):
+        if self._board_frame is None:
+            self._board_frame = encode(" ".join(["GRID", str(self.size), str(self.win_length)] + self.played))
+        return self._board_frame
+
+    def make_move(self, cell, symbol):
+        game_status = ["continue", None, None]
+
+        if not 1 <= cell <= self.size * self.size or cell in self.cells:
+            return False, game_status
+
+        self.cells[cell] = symbol
+        self.moves.append(cell)
+        self.played.append(f"{cell}{symbol}")
+        row, column = divmod(cell - 1, self.size)
+        self.grid[row * (self.size + 1) + column] = ord(symbol)
+        self._board_frame = None
+
+        if self.wins_at(cell, symbol):
+            game_status = ["end", "win", symbol]
+        elif self.check_draw():
+            game_status = ["end", "draw", None]
+        else:
+            self.turn = 'O' if self.turn == 'X' else 'X'
+
+        return True, game_status
+
+    def line_length(self, cell, symbol, direction):
+        # Stones of symbol in a row through cell along direction, counting cell itself
+        row, column = divmod(cell - 1, self.size)
+        length = 1
+        for step in (1, -1):
+            d_row, d_column = direction[0] * step, direction[1] * step
+            r, c = row + d_row, column + d_column
+            while 0 <= r < self.size and 0 <= c < self.size and self.cells.get(r * self.size + c + 1) == symbol:
+                length += 1
+                if length >= self.win_length:
+                    return length
+                r += d_row
+                c += d_column
+        return length
+
+    def wins_at(self, cell, symbol):
+        return any(self.line_length(cell, symbol, direction) >= self.win_length for direction in DIRECTIONS)
+
+    def check_win(self):
+        if self.moves and self.wins_at(self.moves[-1], self.cells[self.moves[-1]]):
+            return self.cells[self.moves[-1]]
+        return None
+
+    def check_draw(self):
+        return len(self.cells) == self.size * self.size
+
+
+def new_game(players, spectators, size=3, win_length=3):
+    if size == 3 and win_length == 3:
+        return TicTacToeGame(players, spectators)
+    return KInARowGame(players, spectators, size, win_length)
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import random
+import time
+
+from clientlib import BoardChanged, CellChanged, GameOver, GameSession, MoveResult, Turn, connect_all
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.connect_time = 0
+        self.moves = 0
+        self.invalid_moves = 0
+        self.games = 0
+        self.boards = 0
+        self.latencies = []
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+class Bot:
+    # Scripted headless client: plays a random free cell whenever it is its turn
+    def __init__(self, host, port, username, stats, spectate=None, binary=False):
+        self.session = GameSession(host, port, username, resume=False, binary=binary)
+        self.stats = stats
+        self.spectate = spectate
+        self.tried = set()
+        self.move_sent = None
+
+    def play(self):
+        free_cells = [cell for cell in self.session.board.free_cells() if cell not in self.tried]
+        if not free_cells:
+            return
+        if self.move_sent is None:
+            self.move_sent = time.perf_counter()
+        cell = random.choice(free_cells)
+        self.tried.add(cell)
+        self.session.move(cell)
+        self.stats.moves += 1
+
+    async def run(self, stop):
+        async for event in self.session.events():
+            if stop.is_set():
+                return
+            if isinstance(event, (BoardChanged, CellChanged)):
+                self.stats.boards += 1
+            elif isinstance(event, Turn) and event.mine:
+                if self.move_sent is not None:
+                    self.stats.latencies.append(time.perf_counter() - self.move_sent)
+                    self.move_sent = None
+                self.tried.clear()
+                self.play()
+            elif isinstance(event, MoveResult) and not event.valid:
+                self.stats.invalid_moves += 1
+                if self.move_sent is not None:
+                    self.play()
+            elif isinstance(event, GameOver):
+                self.stats.games += 1
+                self.move_sent = None
+
+    def close(self):
+        self.session.close()
+
+
+async def connect_bots(bots, stats, concurrency):
+    start = time.perf_counter()
+    connected, errors = await connect_all([bot.session for bot in bots], concurrency)
+    stats.connect_time = time.perf_counter() - start
+    stats.connected = len(connected)
+    stats.failed = len(errors)
+    connected = set(connected)
+    bots = [bot for bot in bots if bot.session in connected]
+    for bot in bots:
+        if bot.spectate is not None:
+            bot.session.spectate(bot.spectate)
+    return bots
+
+
+async def main(args):
+    stats = Stats()
+    bots = [Bot(args.host, args.port, f"{args.prefix}{i}", stats, binary=args.binary) for i in range(args.players)]
+    rooms = max(1, args.players // 2)
+    bots += [Bot(args.host, args.port, f"{args.prefix}s{i}", stats, spectate=random.randint(1, rooms), binary=args.binary)
+             for i in range(args.spectators)]
+
+    bots = await connect_bots(bots, stats, args.concurrency)
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(bot.run(stop)) for bot in bots]
+    start = time.perf_counter()
+    moves_before = stats.moves
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+    moves = stats.moves - moves_before
+
+    stop.set()
+    for bot in bots:
+        bot.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f"connections:   {stats.connected} ok, {stats.failed} failed "
+          f"({stats.connected / stats.connect_time if stats.connect_time else 0:.0f}/s)")
+    print(f"moves:         {moves} in {elapsed:.1f}s ({moves / elapsed:.0f}/s), "
+          f"{stats.invalid_moves} invalid")
+    print(f"games:         {stats.games // 2}")
+    print(f"boards:        {stats.boards}")
+    print(f"move -> YOUR_TURN latency: p50 {stats.percentile(50) * 1000:.2f} ms, "
+          f"p99 {stats.percentile(99) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the TicTacToe server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--spectators", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to play after connecting")
+    parser.add_argument("--concurrency", type=int, default=200, help="connections opened in parallel")
+    parser.add_argument("--prefix", default="bot")
+    parser.add_argument("--binary", action="store_true", help="use the binary protocol")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,183 @@
+import bisect
+import itertools
+
+DEFAULT_RATING = 1200
+K_FACTOR = 32
+BUCKET_SIZE = 256  # entries per bucket of SortedQueue, split in two past twice that
+
+
+class SortedQueue:
+    # Sorted entries kept in buckets of at most 2 * BUCKET_SIZE, with the largest entry of
+    # each bucket in maxes. Finding a bucket is a binary search and an insert or delete only
+    # shifts one bucket, so neither copies the whole queue the way a single list would.
+    def __init__(self):
+        self.buckets = []
+        self.maxes = []
+
+    def __len__(self):
+        return sum(map(len, self.buckets))
+
+    def add(self, entry):
+        if not self.buckets:
+            self.buckets.append([entry])
+            self.maxes.append(entry)
+            return
+        index = min(bisect.bisect_left(self.maxes, entry), len(self.buckets) - 1)
+        bucket = self.buckets[index]
+        bisect.insort(bucket, entry)
+        if len(bucket) > 2 * BUCKET_SIZE:
+            self.buckets.insert(index + 1, bucket[BUCKET_SIZE:])
+            self.maxes.insert(index + 1, bucket[-1])
+            del bucket[BUCKET_SIZE:]
+        self.maxes[index] = bucket[-1]
+
+    def remove(self, entry):
+        index = bisect.bisect_left(self.maxes, entry)
+        bucket = self.buckets[index]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if bucket:
+            self.maxes[index] = bucket[-1]
+        else:
+            del self.buckets[index]
+            del self.maxes[index]
+
+    def below(self, entry):
+        # The largest entry smaller than entry, None if there is none
+        index = bisect.bisect_left(self.maxes, entry)
+        if index < len(self.buckets):
+            position = bisect.bisect_left(self.buckets[index], entry)
+            if position:
+                return self.buckets[index][position - 1]
+        return self.buckets[index - 1][-1] if index else None
+
+    def above(self, entry):
+        # The smallest entry larger than entry, None if there is none
+        index = bisect.bisect_right(self.maxes, entry)
+        if index == len(self.buckets):
+            return None
+        bucket = self.buckets[index]
+        return bucket[bisect.bisect_right(bucket, entry)]
+
+    def clear(self):
+        self.buckets.clear()
+        self.maxes.clear()
+
+
+class Matchmaker:
+    # Players waiting for a game, sorted by rating so the closest opponent is a binary
+    # search away. Joining or leaving stays cheap with tens of thousands queued.
+    # A player's acceptable rating gap grows the longer they wait.
+    def __init__(self, base_window=100, window_growth=50, max_window=1000):
+        self.base_window = base_window
+        self.window_growth = window_growth  # rating points per second of waiting
+        self.max_window = max_window
+        self.ratings = {}
+        self.queue = SortedQueue()  # (rating, seq, username)
+        self.waiting = {}  # username -> (queue entry, time it started waiting)
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, username):
+        return username in self.waiting
+
+    def rating(self, username):
+        return self.ratings.get(username, DEFAULT_RATING)
+
+    def window(self, waited):
+        return min(self.base_window + self.window_growth * waited, self.max_window)
+
+    def enqueue(self, username, now):
+        # Returns the opponent when one is already waiting close enough, otherwise queues
+        entry = (self.rating(username), next(self.seq), username)
+        opponent = self.closest(entry, self.base_window)
+        if opponent is not None:
+            self.remove(opponent)
+            return opponent
+        self.queue.add(entry)
+        self.waiting[username] = (entry, now)
+        return None
+
+    def remove(self, username):
+        entry, _ = self.waiting.pop(username, (None, None))
+        if entry is None:
+            return False
+        self.queue.remove(entry)
+        return True
+
+    def closest(self, entry, window):
+        rating = entry[0]
+        best = None
+        for neighbour in (self.queue.below(entry), self.queue.above(entry)):
+            if neighbour is not None:
+                other_rating, _, other = neighbour
+                gap = abs(other_rating - rating)
+                if gap <= window and (best is None or gap < best[0]):
+                    best = (gap, other)
+        return best[1] if best else None
+
+    def match_waiting(self, now):
+        # Longest waiting players first, each with the window it has earned so far
+        pairs = []
+        for username in list(self.waiting):
+            if username not in self.waiting:
+                continue
+            entry, since = self.waiting[username]
+            opponent = self.closest(entry, self.window(now - since))
+            if opponent is not None:
+                self.remove(username)
+                self.remove(opponent)
+                pairs.append((username, opponent))
+        return pairs
+
+    def waited(self, now, max_wait):
+        # Players waiting for at least max_wait seconds, oldest first
+        expired = []
+        for username, (_, since) in self.waiting.items():
+            if now - since < max_wait:
+                break
+            expired.append(username)
+        return expired
+
+    def record_result(self, first, second, score):
+        # score is 1 when first won, 0.5 for a draw and 0 when second won (Elo)
+        first_rating = self.rating(first)
+        second_rating = self.rating(second)
+        expected = 1 / (1 + 10 ** ((second_rating - first_rating) / 400))
+        change = K_FACTOR * (score - expected)
+        self.ratings[first] = round(first_rating + change)
+        self.ratings[second] = round(second_rating - change)
+
+
+class SharedMatchmaker(Matchmaker):
+    # Players wait in a queue kept elsewhere, the supervisor's or the broker's, so they can
+    # be paired with players of other workers or nodes. Only the local waiting list is kept
+    # here, for the AI fallback and for players leaving the queue. notify() posts
+    # "wait <rating> <username>" and "unwait <username>" to that queue.
+    def __init__(self, notify):
+        super().__init__()
+        self.notify = notify
+
+    def enqueue(self, username, now):
+        self.waiting[username] = (None, now)
+        self.notify(f"wait {self.rating(username)} {username}")
+        return None
+
+    def requeue(self, username):
+        # The player was paired but the opponent was gone
+        if username in self.waiting:
+            self.notify(f"wait {self.rating(username)} {username}")
+
+    def take(self, username):
+        # The player was paired and stops waiting here
+        return self.waiting.pop(username, None) is not None
+
+    def remove(self, username):
+        if not self.take(username):
+            return False
+        self.notify(f"unwait {username}")
+        return True
+
+    def match_waiting(self, now):
+        return []
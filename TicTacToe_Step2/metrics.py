@@ -0,0 +1,160 @@
+import asyncio
+import bisect
+import math
+
+from protocol import MAX_FRAME
+
+# Bucket upper bounds in seconds
+FAST_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+FAN_OUT_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 1e-2)
+
+
+class Counter:
+    __slots__ = ("name", "help", "value")
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    # Read when scraped, so keeping it up to date costs nothing on the hot path
+    __slots__ = ("name", "help", "read")
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def snapshot(self):
+        return self.read()
+
+    def samples(self):
+        yield self.name, self.read()
+
+
+class Histogram:
+    __slots__ = ("name", "help", "bounds", "counts", "sum")
+    kind = "histogram"
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            total += count
+            buckets[bound] = total
+        return {"buckets": buckets, "sum": self.sum, "count": total}
+
+    def samples(self):
+        snapshot = self.snapshot()
+        for bound, total in snapshot["buckets"].items():
+            le = "+Inf" if bound == math.inf else repr(bound)
+            yield f'{self.name}_bucket{{le="{le}"}}', total
+        yield f"{self.name}_sum", snapshot["sum"]
+        yield f"{self.name}_count", snapshot["count"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class EngineMetrics(Registry):
+    # Everything a GameServer counts. Events only bump a number or fill a histogram
+    # bucket; gauges are computed from the engine's state when scraped.
+    def __init__(self, server):
+        super().__init__()
+        self.connections = self.add(Counter("tictactoe_connections_total",
+                                            "Clients that completed the handshake"))
+        self.moves = self.add(Counter("tictactoe_moves_total", "Valid moves"))
+        self.invalid_moves = self.add(Counter("tictactoe_invalid_moves_total",
+                                              "Moves answered with INVALID_MOVE"))
+        self.bytes_sent = self.add(Counter("tictactoe_bytes_sent_total", "Bytes written to client sockets"))
+        self.frames_sent = self.add(Counter("tictactoe_frames_sent_total", "Messages written to client sockets"))
+        self.socket_writes = self.add(Counter("tictactoe_socket_writes_total",
+                                              "Batches of messages handed to client sockets, one send call each"))
+        self.chat_messages = self.add(Counter("tictactoe_chat_messages_total", "Chat lines posted to a room"))
+        self.chat_limited = self.add(Counter("tictactoe_chat_rate_limited_total",
+                                             "Chat lines refused because the user sent too many"))
+        self.idle_timeouts = self.add(Counter("tictactoe_idle_timeouts_total",
+                                              "Connections dropped after going silent"))
+        self.turn_timeouts = self.add(Counter("tictactoe_turn_timeouts_total",
+                                              "Players removed for not moving in time"))
+        self.make_move = self.add(Histogram("tictactoe_make_move_seconds", "Time spent applying a move",
+                                            FAST_BUCKETS))
+        self.fan_out = self.add(Histogram("tictactoe_broadcast_seconds",
+                                          "Time spent queueing a board for everyone in a room", FAN_OUT_BUCKETS))
+        self.add(Gauge("tictactoe_clients", "Connected clients, AI players excluded",
+                       lambda: len(server.clients) - len(server.rooms.bots)))
+        self.add(Gauge("tictactoe_rooms", "Rooms hosted by this node", server.rooms.hosted))
+        self.add(Gauge("tictactoe_waiting_players", "Players in the matchmaking queue",
+                       lambda: len(server.rooms.matchmaker)))
+        self.add(Gauge("tictactoe_timers", "Timers pending in the timer wheel", lambda: len(server.wheel)))
+        self.add(Gauge("tictactoe_games_played", "Games finished since the server started",
+                       lambda: server.games_played))
+        self.add(Gauge("tictactoe_send_queue_frames", "Frames queued for all clients",
+                       lambda: sum(server.send_queue_depths())))
+        self.add(Gauge("tictactoe_send_queue_max_frames", "Frames queued for the client furthest behind",
+                       lambda: max(server.send_queue_depths(), default=0)))
+
+
+async def serve_metrics(registry, host, port):
+    # Bare HTTP/1.0 endpoint for a Prometheus scraper: GET /metrics
+    async def handle(reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request) >= 2 and request[0] == b"GET" and request[1] == b"/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port, limit=MAX_FRAME)
@@ -0,0 +1,157 @@
+import functools
+import struct
+
+# Every message on the wire is one line of UTF-8 text ending with "\n", so several
+# messages can be sent back to back and still be told apart by the receiver.
+
+MAX_FRAME = 64 * 1024
+
+
+def encode(message):
+    # Line breaks inside a message (the board, multi-line chat) travel as spaces
+    return (message.strip().replace("\n", " ") + "\n").encode()
+
+
+def decode(frame):
+    return frame.decode(errors="replace").rstrip("\r\n")
+
+
+class FrameDecoder:
+    # Splits the bytes of a blocking socket back into messages
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        self.buffer += data
+        *frames, self.buffer = self.buffer.split(b"\n")
+        if len(self.buffer) > MAX_FRAME:
+            raise ValueError("Frame too long")
+        return [decode(frame) for frame in frames if frame.strip()]
+
+
+# Binary protocol, asked for by sending "BINARY <username>" (or "BINARY RESUME <token>")
+# as the first line. The server still answers that line in text; after it both sides send
+# binary frames: an opcode byte, then a payload whose layout the opcode fixes. NAME and
+# TEXT carry a u16 length, TEXT wraps any message of the text protocol that has no opcode.
+BINARY = "BINARY "
+OP_BOARD = 1  # u16: the 3x3 cells in base 3, cell 1 the lowest digit, 0 empty, 1 X, 2 O
+OP_YOUR_TURN = 2
+OP_OPPONENT_TURN = 3  # u16 id of a name announced with NAME
+OP_VALID_MOVE = 4
+OP_INVALID_MOVE = 5
+OP_SYMBOL_X = 6
+OP_SYMBOL_O = 7
+OP_WIN = 8
+OP_LOSS = 9
+OP_DRAW = 10
+OP_PING = 11
+OP_PONG = 12
+OP_NAME = 13  # u16 id, u16 length, UTF-8 username
+OP_TEXT = 14  # u16 length, UTF-8 message
+OP_MOVE = 15  # u16 cell, client to server only
+OP_TURN_OF = 16  # u16 name id: "MESSAGE It's <name>'s turn."
+OP_WON = 17  # u16 name id: "MESSAGE <name> won!"
+OP_CELL_X = 18  # u8, move number in the high four bits and cell in the low four: "CELL <seq> <cell> X"
+OP_CELL_O = 19
+OP_WIDE_CELL_X = 20  # u16 move number, u16 cell: the same for boards past 3x3
+OP_WIDE_CELL_O = 21
+MAX_NAMES = 1 << 16
+
+U16 = struct.Struct("<H")
+FIXED_FRAMES = {encode(message): bytes((opcode,)) for message, opcode in (
+    ("YOUR_TURN", OP_YOUR_TURN), ("VALID_MOVE", OP_VALID_MOVE), ("INVALID_MOVE", OP_INVALID_MOVE),
+    ("SYMBOL X", OP_SYMBOL_X), ("SYMBOL O", OP_SYMBOL_O), ("Win", OP_WIN), ("LOSS", OP_LOSS),
+    ("DRAW", OP_DRAW), ("PING", OP_PING), ("PONG", OP_PONG))}
+CLIENT_COMMANDS = {"PING": bytes((OP_PING,)), "PONG": bytes((OP_PONG,))}
+CELL_DIGITS = {ord("X"): 1, ord("O"): 2}
+
+
+def text_frame(frame):
+    payload = frame.rstrip(b"\n")
+    return bytes((OP_TEXT,)) + U16.pack(len(payload)) + payload
+
+
+@functools.lru_cache(maxsize=4096)
+def binary_frame(frame):
+    # The binary form of a text frame. Frames are shared by every receiver, so each one is
+    # only converted once; OPPONENT_TURN depends on the receiver and goes through names_frame.
+    fixed = FIXED_FRAMES.get(frame)
+    if fixed is not None:
+        return fixed
+    if frame.startswith(b"BOARD "):
+        cells = frame[6:-1].replace(b"|", b"").replace(b" ", b"")
+        if len(cells) == 9:
+            value = 0
+            for cell in reversed(cells):
+                value = value * 3 + CELL_DIGITS.get(cell, 0)
+            return bytes((OP_BOARD,)) + U16.pack(value)
+    if frame.startswith(b"CELL "):
+        # Anything but "CELL <seq> <cell> X|O" with both numbers in a u16 goes as TEXT. On a
+        # 3x3 board both fit in one byte, so the delta stays smaller than a whole BOARD.
+        try:
+            seq, cell, symbol = frame[5:-1].split()
+            seq, cell = int(seq), int(cell)
+            if symbol in (b"X", b"O"):
+                if 0 <= seq < 16 and 0 <= cell < 16:
+                    return bytes((OP_CELL_X if symbol == b"X" else OP_CELL_O, seq << 4 | cell))
+                opcode = OP_WIDE_CELL_X if symbol == b"X" else OP_WIDE_CELL_O
+                return bytes((opcode,)) + U16.pack(seq) + U16.pack(cell)
+        except (ValueError, struct.error):
+            pass
+    return text_frame(frame)
+
+
+# Messages around one username, sent with the id of the name: (opcode, before, after)
+NAMED_FRAMES = (
+    (OP_OPPONENT_TURN, b"OPPONENT_TURN ", b"\n"),
+    (OP_TURN_OF, b"MESSAGE It's ", b"'s turn.\n"),
+    (OP_WON, b"MESSAGE ", b" won!\n"),
+)
+
+
+def names_frame(frame, names):
+    # The binary form of a message naming a player, with the name's id for this receiver
+    # and a NAME frame announcing it on first use. None for any other message.
+    for opcode, before, after in NAMED_FRAMES:
+        if frame.startswith(before) and frame.endswith(after) and len(frame) > len(before) + len(after):
+            break
+    else:
+        return None
+    username = frame[len(before):-len(after)]
+    frames = b""
+    name_id = names.get(username)
+    if name_id is None:
+        if len(names) >= MAX_NAMES:
+            names.clear()
+        name_id = names[username] = len(names)
+        frames = bytes((OP_NAME,)) + U16.pack(name_id) + U16.pack(len(username)) + username
+    return frames + bytes((opcode,)) + U16.pack(name_id)
+
+
+def is_binary_board(frame):
+    return frame[0] == OP_BOARD or frame[0] == OP_TEXT and frame.startswith(b"GRID ", 3)
+
+
+def is_binary_cell(frame):
+    return OP_CELL_X <= frame[0] <= OP_WIDE_CELL_O
+
+
+def is_turn_message(frame):
+    # "MESSAGE It's <name>'s turn." for spectators, as text or as TURN_OF (a frame that
+    # starts with the NAME announcing the name is not one, the name must still arrive)
+    return frame[0] == OP_TURN_OF or frame.startswith(b"MESSAGE It's ") and frame.endswith(b"'s turn.\n")
+
+
+def binary_command(message):
+    # What a client sends in the binary protocol for a message of the text protocol. Only
+    # MOVE, PING and PONG have opcodes in that direction, everything else (chat that reads
+    # like a server message included) travels as TEXT.
+    if message.startswith("MOVE "):
+        try:
+            return bytes((OP_MOVE,)) + U16.pack(int(message[5:]))
+        except (ValueError, struct.error):
+            pass
+    command = CLIENT_COMMANDS.get(message)
+    if command is not None:
+        return command
+    return text_frame(encode(message))
@@ -0,0 +1,22 @@
+import time
+
+
+class TokenBucket:
+    # Allows `rate` actions per second on average, and bursts of up to `burst` after a
+    # quiet period. Refilled lazily when asked, so idle buckets cost nothing.
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
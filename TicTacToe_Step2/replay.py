@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import glob
+import os
+import struct
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from game import IS_WIN
+
+# One record per game, no padding:
+#   u16 length of the rest of the record,
+#   u8 length + UTF-8 name of X, u8 length + UTF-8 name of O,
+#   u32 unix time the game ended, u8 result << 4 | number of moves,
+#   the cells played (0-8) two per byte, first move in the low nibble. X always moves first.
+RESULTS = ("x", "o", "draw", "abandoned")
+LENGTH = struct.Struct("<H")
+FINISHED = struct.Struct("<I")
+FLUSH_INTERVAL = 1
+FLUSH_SIZE = 64 * 1024
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+GameRecord = namedtuple("GameRecord", "x o finished result moves")
+
+
+def pack_name(username):
+    name = username.encode()[:255]
+    return bytes((len(name),)) + name
+
+
+def pack_game(x_player, o_player, moves, result, finished):
+    # moves are cells 1-9 in the order they were played
+    packed = bytearray(pack_name(x_player))
+    packed += pack_name(o_player)
+    packed += FINISHED.pack(int(finished))
+    packed.append(RESULTS.index(result) << 4 | len(moves))
+    for i in range(0, len(moves), 2):
+        low = moves[i] - 1
+        high = moves[i + 1] - 1 if i + 1 < len(moves) else 0
+        packed.append(high << 4 | low)
+    return LENGTH.pack(len(packed)) + packed
+
+
+def unpack_games(data):
+    # Yields every record of data. One that doesn't parse is skipped, its length still
+    # says where the next one starts; a torn record at the end is ignored.
+    offset = 0
+    end = len(data)
+    while offset + LENGTH.size <= end:
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        if offset + length > end:
+            return
+        record = unpack_game(data[offset:offset + length])
+        offset += length
+        if record is not None:
+            yield record
+
+
+def unpack_game(data):
+    # The game of one record without its length, None unless every field is valid
+    try:
+        x_length = data[0]
+        x_player = data[1:1 + x_length].decode(errors="replace")
+        offset = 1 + x_length
+        o_length = data[offset]
+        o_player = data[offset + 1:offset + 1 + o_length].decode(errors="replace")
+        offset += 1 + o_length
+        finished, = FINISHED.unpack_from(data, offset)
+        header = data[offset + 4]
+        offset += 5
+    except (IndexError, struct.error):
+        return None
+    count = header & 0x0F
+    if header >> 4 >= len(RESULTS) or count > 9 or offset + (count + 1) // 2 != len(data):
+        return None
+    moves = []
+    for byte in data[offset:]:
+        moves.append((byte & 0x0F) + 1)
+        moves.append((byte >> 4) + 1)
+    if max(moves[:count], default=1) > 9:
+        return None
+    return GameRecord(x_player, o_player, finished, RESULTS[header >> 4], moves[:count])
+
+
+def segments(directory, prefix="games"):
+    return sorted(glob.glob(os.path.join(directory, f"{prefix}*.log")))
+
+
+def read_games(directory, prefix="games"):
+    # Streams the games of every segment, oldest segment first
+    for path in segments(directory, prefix):
+        with open(path, "rb") as f:
+            yield from unpack_games(f.read())
+
+
+def board_after(record, moves=None):
+    # (x_bits, o_bits) after the first moves of the game, all of them by default
+    x_bits = o_bits = 0
+    for i, cell in enumerate(record.moves[:moves]):
+        if i % 2:
+            o_bits |= 1 << (cell - 1)
+        else:
+            x_bits |= 1 << (cell - 1)
+    return x_bits, o_bits
+
+
+class ReplayLog:
+    # Append-only log of finished games. record() only packs the game into a buffer, a
+    # task writes the buffer from a helper thread every second or once it holds 64 KiB.
+    # Segments are files of about segment_size bytes: <prefix>-000001.log, ...
+    def __init__(self, directory, prefix="games", segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.buffer = bytearray()
+        self.games = 0
+        self.file = None
+        self.segment = 0
+        self.task = None
+        self.executor = None
+        self.wakeup = None
+
+    def record(self, x_player, o_player, moves, result):
+        self.buffer += pack_game(x_player, o_player, moves, result, time.time())
+        self.games += 1
+        if len(self.buffer) >= FLUSH_SIZE and self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.buffer:
+                batch, self.buffer = self.buffer, bytearray()
+                await loop.run_in_executor(self.executor, self.write, batch)
+
+    def open_segment(self):
+        # Always a new segment, so nothing is appended behind a torn record that an earlier
+        # run or a failed write left at the end of the last one
+        os.makedirs(self.directory, exist_ok=True)
+        existing = segments(self.directory, f"{self.prefix}-")
+        self.segment = max(self.segment, int(existing[-1][-10:-4]) if existing else 0) + 1
+        path = os.path.join(self.directory, f"{self.prefix}-{self.segment:06d}.log")
+        self.file = open(path, "ab")
+
+    def write(self, batch):
+        try:
+            if self.file is None:
+                self.open_segment()
+            if self.file.tell() and self.file.tell() + len(batch) > self.segment_size:
+                self.file.close()
+                self.open_segment()
+            self.file.write(batch)
+            self.file.flush()
+        except OSError:
+            self.file = None  # retried with the next batch, this one is lost
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.buffer:
+            batch, self.buffer = self.buffer, bytearray()
+            self.write(batch)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def show_board(x_bits, o_bits):
+    cells = ["X" if x_bits >> cell & 1 else "O" if o_bits >> cell & 1 else str(cell + 1) for cell in range(9)]
+    return "{}|{}|{}\n{}|{}|{}\n{}|{}|{}".format(*cells)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays the games written with --replay-dir")
+    parser.add_argument("directory")
+    parser.add_argument("--game", type=int, default=None, help="print the final board of game number N (from 0)")
+    parser.add_argument("--moves", type=int, default=None, help="with --game, only replay the first N moves")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    results = Counter()
+    wins = 0
+    for number, record in enumerate(read_games(args.directory)):
+        results[record.result] += 1
+        x_bits, o_bits = board_after(record)
+        wins += IS_WIN[x_bits] | IS_WIN[o_bits]
+        if number == args.game:
+            print(f"Game {number}: X {record.x}, O {record.o}, "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.finished))}, {record.result}")
+            print(show_board(*board_after(record, args.moves)))
+    elapsed = time.perf_counter() - started
+    games = sum(results.values())
+    print(f"{games} games replayed in {elapsed:.2f}s ({games / elapsed if elapsed else 0:.0f}/s), "
+          f"{wins} won on the board, results {dict(results)}")
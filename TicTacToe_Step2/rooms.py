@@ -0,0 +1,797 @@
+import json
+import random
+import time
+from collections import deque
+
+from ai import BotClient
+from directory import chat_channel, node_channel, player_channel, room_channel
+from eventlog import LEVELS
+from game import BOARD_FRAMES, CELL_FRAME, TicTacToeGame, new_game
+from matchmaking import Matchmaker
+from protocol import decode, encode
+
+RESULTS = {1: "win", 0.5: "draw", 0: "loss"}
+DEBUG = LEVELS["debug"]
+
+
+class Room:
+    # One game with its own players and spectators. The flow is the one the server used
+    # to run for its single global game.
+    def __init__(self, manager, room_id):
+        self.manager = manager
+        self.server = manager.server
+        self.room_id = room_id
+        self.players = []
+        self.spectators = []
+        self.game = None
+        self.games_played = 0
+        self.commands = deque()
+        self.running = False
+        self.pending_players = 0
+        self.remote = None  # RemoteWatchers while other nodes have spectators here
+        self.turn_timer = None
+        self.chat_history = deque(maxlen=self.server.chat_history)  # frames replayed to newcomers
+
+    def log(self, message, level="info"):
+        self.server.log(message, level, room=self.room_id)
+
+    def debugging(self):
+        # Debug lines are checked for before they are formatted, they come on every move
+        return self.server.logs.level <= DEBUG
+
+    def submit(self, command, *args):
+        # Every change to the room goes through here, so the room handles one command at a
+        # time in arrival order. Commands run right away while the room is idle; one submitted
+        # by a running command waits for it to finish. Commands never await, so the room
+        # never has to be held across a suspension point.
+        self.commands.append((command, args))
+        if not self.running:
+            self.running = True
+            self.run_commands()
+
+    def run_commands(self):
+        while self.commands:
+            command, args = self.commands.popleft()
+            try:
+                command(*args)
+            except Exception as e:
+                self.log(f"{command.__name__} failed: {e!r}", "error")
+        self.running = False
+
+    def members(self):
+        return self.players + self.spectators
+
+    def send_to_all(self, message):
+        frame = encode(message)
+        for username in self.members():
+            self.server.clients[username].send(frame)
+        if self.remote is not None:
+            self.remote.send(frame)
+
+    def send_to_spectators(self, message):
+        frame = encode(message)
+        for username in self.spectators:
+            self.server.clients[username].send(frame)
+        if self.remote is not None:
+            self.remote.send(frame)
+
+    def chat(self, line):
+        # Chat goes through each connection's chat queue, behind any board or turn frame
+        self.log(line)
+        frame = encode(line)
+        self.chat_history.append(frame)
+        for username in self.members():
+            self.server.clients[username].send_chat(frame)
+        if self.remote is not None:
+            self.remote.send_chat(frame)
+
+    def send_chat_history(self, client):
+        for frame in self.chat_history:
+            client.send_chat(frame)
+
+    def changed(self):
+        self.server.observer.on_room_changed(self.room_id, list(self.players), list(self.spectators))
+
+    def add_player(self, username):
+        client = self.server.clients[username]
+        self.players.append(username)
+        self.changed()
+        client.send(encode(f"MESSAGE You are a player in room {self.room_id}\n"))
+        self.send_chat_history(client)
+
+    def add_spectator(self, username):
+        client = self.server.clients[username]
+        self.spectators.append(username)
+        self.changed()
+        client.send(encode(f"MESSAGE You are a spectator in room {self.room_id}\n"))
+        self.send_chat_history(client)
+        if self.game is not None:
+            self.game.add_spectator(username, client)
+
+    def player_with_symbol(self, symbol):
+        for player, (_, player_symbol) in self.game.players.items():
+            if player_symbol == symbol:
+                return player
+
+    def start_game(self):
+        if len(self.players) != 2:
+            return
+
+        symbols = ['X', 'O']
+        random.shuffle(symbols)
+        players = {}
+        spectators = {}
+
+        for i, username in enumerate(self.players):
+            client = self.server.clients[username]
+            symbol = symbols[i]
+            client.send(encode(f"SYMBOL {symbol}\n"))
+            if self.debugging():
+                self.log(f"{username} is appointed {symbol}", "debug")
+            players[username] = (client, symbol)
+
+        for username in self.spectators:
+            spectators[username] = (self.server.clients[username],)
+        if self.remote is not None:
+            spectators[None] = (self.remote,)
+
+        self.log(f"Game {self.games_played} started\n")
+        self.game = new_game(players, spectators, self.server.board_size, self.server.win_length)
+
+        self.server.observer.on_board_changed(self.room_id, self.game)
+        self.game.broadcast_board()
+        self.announce_turn()
+
+    def announce_turn(self):
+        turn_username = self.player_with_symbol(self.game.turn)
+        opponent_username = self.game.get_opponent_username(turn_username)
+        if self.debugging():
+            self.log(f"It's {turn_username}'s turn.\n", "debug")
+
+        self.server.clients[turn_username].send(encode("YOUR_TURN"))
+        self.server.clients[opponent_username].send(encode(f"OPPONENT_TURN {turn_username}"))
+        self.start_turn_clock()
+
+        self.send_to_spectators(f"MESSAGE It's {turn_username}'s turn.")
+
+    def handle_move(self, client, username, cell):
+        if username not in self.players or self.game is None or username not in self.game.players:
+            self.reject_move(client)
+            return
+
+        symbol = self.game.players[username][1]
+        if self.game.turn != symbol:
+            self.reject_move(client)
+            return
+
+        metrics = self.server.metrics
+        started = time.perf_counter()
+        valid_move, game_status = self.game.make_move(cell, symbol)
+        metrics.make_move.observe(time.perf_counter() - started)
+        if not valid_move:
+            self.reject_move(client)
+            return
+
+        metrics.moves.inc()
+        started = time.perf_counter()
+        self.game.broadcast_cell(cell, symbol)
+        metrics.fan_out.observe(time.perf_counter() - started)
+        self.server.observer.on_board_changed(self.room_id, self.game)
+        client.send(encode("VALID_MOVE"))
+
+        if self.debugging():
+            self.log(f"VALID_MOVE message sent to {username}.", "debug")
+            self.log(f"{username} made a move at cell {cell}.", "debug")
+            self.log(f"Game status: {game_status}\n", "debug")
+
+        if game_status[0] == "end":
+            self.finish_game(game_status)
+        else:
+            self.announce_turn()
+
+    def send_board(self, client):
+        # Asked for by a client that missed a CELL delta
+        if self.game is not None:
+            client.send(self.game.board_frame())
+
+    def holds_seat(self, username):
+        return self.game is not None and username in self.game.players
+
+    def player_away(self, username):
+        self.send_to_all(f"MESSAGE {username} lost connection, waiting for them to come back")
+
+    def resume(self, username, client):
+        # Everything the client needs to pick up where it was, in one SNAPSHOT message:
+        # room, own symbol, symbol to move and the nine cells. Larger boards send "-" for
+        # the cells and follow with their GRID message.
+        if self.game is not None and username in self.game.players:
+            symbol = self.game.players[username][1]
+            self.game.players[username] = (client, symbol)
+            if self.game.size == 3:
+                cells = "".join(self.game.cell(cell) for cell in range(1, 10))
+                client.send(encode(f"SNAPSHOT {self.room_id} {symbol} {self.game.turn} {cells}"))
+            else:
+                client.send(encode(f"SNAPSHOT {self.room_id} {symbol} {self.game.turn} -"))
+                client.send(self.game.board_frame())
+            self.send_to_all(f"MESSAGE {username} is back")
+            return
+        if self.game is not None and username in self.game.spectators:
+            self.game.add_spectator(username, client)
+        role = "player" if username in self.players else "spectator"
+        client.send(encode(f"MESSAGE You are a {role} in room {self.room_id}"))
+
+    def reject_move(self, client):
+        self.server.metrics.invalid_moves.inc()
+        client.send(encode("INVALID_MOVE"))
+
+    def record_replay(self, result, players=None):
+        replays = self.server.replays
+        if replays is not None and type(self.game) is TicTacToeGame:  # the record format only holds tic-tac-toe
+            players = players or {symbol: username for username, (_, symbol) in self.game.players.items()}
+            replays.record(players.get('X', ""), players.get('O', ""), self.game.moves, result)
+
+    def finish_game(self, game_status):
+        game = self.game
+        self.record_replay(game_status[2].lower() if game_status[1] == "win" else "draw")
+        if game_status[1] == "win":
+            winning_player = self.player_with_symbol(game_status[2])
+            self.server.clients[winning_player].send(encode("Win"))
+            if self.debugging():
+                self.log(f"WIN message has been sent to {winning_player}\n", "debug")
+            losing_player = game.get_opponent_username(winning_player)
+            if losing_player in self.server.clients:
+                self.server.clients[losing_player].send(encode("LOSS"))
+                if self.debugging():
+                    self.log(f"LOSS message has been sent to {losing_player}\n", "debug")
+            self.log(f"{winning_player} won!\n")
+            if losing_player is not None:
+                self.manager.record_result(winning_player, losing_player, 1)
+
+            self.send_to_spectators(f"MESSAGE {winning_player} won!\n")
+
+        elif game_status[1] == "draw":
+            self.send_to_all("DRAW")
+            self.log("It's a draw.\n")
+            self.manager.record_result(*game.players, 0.5)
+
+        self.games_played += 1
+        self.server.game_finished()
+        self.start_game()
+
+    def remove(self, username):
+        if username in self.spectators:
+            self.spectators.remove(username)
+            if self.game is not None:
+                self.game.spectators.pop(username, None)
+
+        elif username in self.players:
+            self.players.remove(username)
+            disconnected_player_symbol = None
+            if self.game is not None and username in self.game.players:
+                disconnected_player_symbol = self.game.players.pop(username)[1]
+            self.send_to_all(f"MESSAGE Player {username} has disconnected and/or left the game.")
+            self.log(f"Player {username} has disconnected and/or left the game.")
+
+            if self.game is not None and self.spectators:
+                # Replace the disconnected player with a spectator
+                new_player = self.spectators.pop(0)
+                self.game.spectators.pop(new_player, None)
+                self.players.append(new_player)
+
+                if len(self.players) == 2 and disconnected_player_symbol is not None:
+                    self.replace_player(username, new_player, disconnected_player_symbol)
+
+            elif self.game is not None:
+                self.send_to_all("MESSAGE There are no available replacements. The game is over.")
+                self.log("There are no available replacements. The game is over.")
+
+                players = {symbol: player for player, (_, symbol) in self.game.players.items()}
+                if disconnected_player_symbol is not None:
+                    players[disconnected_player_symbol] = username
+                self.record_replay("abandoned", players)
+
+                # Reset the game
+                self.game = None
+                self.start_turn_clock()
+
+        self.changed()
+
+    def replace_player(self, username, new_player, symbol):
+        other_player = self.players[0] if self.players[1] == new_player else self.players[1]
+        self.send_to_all(f"MESSAGE Opponent {username} is now replaced by {new_player}")
+        self.log(f"Opponent {username} is now replaced by {new_player}")
+
+        new_player_client = self.server.clients[new_player]
+        self.game.players[new_player] = (new_player_client, symbol)
+        new_player_client.send(encode(f"SYMBOL {symbol}\n"))
+        new_player_client.send(encode("MESSAGE You are joining the game as an opponent!\n"))
+        self.log(f"{new_player} is joining the game as an opponent!")
+
+        other_player_client = self.server.clients[other_player]
+        if self.game.turn == symbol:
+            new_player_client.send(encode("YOUR_TURN"))
+            other_player_client.send(encode(f"OPPONENT_TURN {new_player}"))
+        else:
+            new_player_client.send(encode(f"OPPONENT_TURN {other_player}"))
+            other_player_client.send(encode("YOUR_TURN"))
+        self.start_turn_clock()
+
+    def start_turn_clock(self):
+        if self.turn_timer is not None:
+            self.turn_timer.cancel()
+            self.turn_timer = None
+        if self.server.turn_timeout and self.game is not None:
+            self.turn_timer = self.server.wheel.schedule(self.server.turn_timeout, self.submit, self.turn_expired,
+                                                         self.game, len(self.game.moves))
+
+    def turn_expired(self, game, moves):
+        if self.game is not game or len(game.moves) != moves:
+            return  # somebody moved in the meantime
+        self.turn_timer = None
+        username = self.player_with_symbol(game.turn)
+        if username is None or username in self.manager.bots:
+            return
+        self.server.metrics.turn_timeouts.inc()
+        self.server.evict(username, "You took too long to move")
+
+    def watch(self):
+        # Another node has spectators for this room, they get what our spectators get
+        if self.remote is None:
+            self.remote = RemoteWatchers(self.server.directory, self.room_id)
+            if self.game is not None:
+                self.game.spectators[None] = (self.remote,)
+        self.remote.nodes += 1
+        if self.game is not None:
+            self.remote.send(self.game.board_frame())
+
+    def unwatch(self):
+        if self.remote is None:
+            return
+        self.remote.nodes -= 1
+        if self.remote.nodes == 0:
+            self.remote = None
+            if self.game is not None:
+                self.game.spectators.pop(None, None)
+
+    def close(self):
+        if self.server.directory is not None:
+            self.server.directory.unregister(self.room_id)
+
+
+class RemoteWatchers:
+    # Stands in for the spectators other nodes have in a room: whatever the room sends its
+    # spectators is published on the room's channel. It sits in game.spectators under the
+    # key None, which is never a username.
+    def __init__(self, directory, room_id):
+        self.directory = directory
+        self.channel = room_channel(room_id)
+        self.chat_channel = chat_channel(room_id)
+        self.nodes = 0
+
+    def send(self, data):
+        self.directory.publish(self.channel, data)
+
+    def send_chat(self, data):
+        self.directory.publish(self.chat_channel, data)
+
+
+class RemotePlayer:
+    # Stands in for a player of one of our rooms whose connection is on another node.
+    # What the room sends them is published on their channel, prefixed with the room id:
+    #   <room id> send|chat <frame>, <room id> result <result> <rating>,
+    #   <room id> requeue when they are to wait for a new opponent, <room id> close
+    queue = ()  # nothing waits here, the connection's own queue is on the other node
+
+    def __init__(self, directory, node, username, room_id):
+        self.directory = directory
+        self.node = node
+        self.channel = player_channel(node, username)
+        self.room_id = room_id
+
+    def post(self, message):
+        self.directory.publish(self.channel, encode(f"{self.room_id} {message}"))
+
+    def send(self, data):
+        self.post(f"send {decode(data)}")
+
+    def send_chat(self, data):
+        self.post(f"chat {decode(data)}")
+
+    def close(self):
+        self.post("close")
+
+    abort = close
+
+
+class RemoteRoom(Room):
+    # Local spectators of a room hosted by another node. That node publishes what its own
+    # spectators see, this forwards it to ours as it arrives. A local player seated there
+    # gets their frames on their own channel; their moves, board requests and leaving
+    # are relayed to the hosting node.
+    def __init__(self, manager, room_id, node):
+        super().__init__(manager, room_id)
+        self.node = node
+        self.board = None  # latest BOARD or GRID frame, for spectators joining later
+        self.cells = []  # CELL frames since that board
+        self.server.directory.subscribe(room_channel(room_id), self.forward)
+        self.server.directory.subscribe(chat_channel(room_id), self.forward_chat)
+        self.server.directory.publish(node_channel(node), encode(f"watch {room_id}"))
+
+    def forward(self, data):
+        if data.startswith(BOARD_FRAMES):
+            self.board = data
+            self.cells = []
+        elif data.startswith(CELL_FRAME):
+            self.cells.append(data)
+        for username in self.spectators:
+            self.server.clients[username].send(data)
+
+    def forward_chat(self, data):
+        # Only holds the chat since this node started watching
+        self.chat_history.append(data)
+        for username in self.spectators:
+            self.server.clients[username].send_chat(data)
+
+    def post(self, command, line):
+        self.server.directory.publish(node_channel(self.node), encode(f"{command} {self.room_id} {line}"))
+
+    def chat(self, line):
+        # The hosting node posts it to everyone, our spectators included
+        self.post("chat", line)
+
+    def add_player(self, username):
+        # The hosting node greets them
+        self.players.append(username)
+        self.changed()
+
+    def add_spectator(self, username):
+        super().add_spectator(username)
+        self.send_board(self.server.clients[username])
+
+    def send_board(self, client):
+        for username in self.players:
+            if self.server.clients.get(username) is client:
+                self.post("board", username)
+                return
+        if self.board is not None:
+            client.send(self.board)
+            for frame in self.cells:
+                client.send(frame)
+
+    def handle_move(self, client, username, cell):
+        if username in self.players:
+            self.post("move", f"{cell} {username}")
+        else:
+            self.reject_move(client)
+
+    def holds_seat(self, username):
+        return username in self.players
+
+    def player_away(self, username):
+        self.post("away", username)
+
+    def resume(self, username, client):
+        if username in self.players:
+            self.post("resume", username)
+        else:
+            super().resume(username, client)
+
+    def remove(self, username):
+        if username in self.players:
+            self.players.remove(username)
+            self.post("leave", username)
+            self.changed()
+        else:
+            super().remove(username)
+
+    def close(self):
+        self.server.directory.unsubscribe(room_channel(self.room_id), self.forward)
+        self.server.directory.unsubscribe(chat_channel(self.room_id), self.forward_chat)
+        self.server.directory.publish(node_channel(self.node), encode(f"unwatch {self.room_id}"))
+
+
+class RoomManager:
+    # Keeps every room of the server and the matchmaking queue in front of them. Looking
+    # up the room of a username is O(1).
+    def __init__(self, server, matchmaker=None, bot_after=None, first_room_id=1, room_id_step=1):
+        self.server = server
+        self.matchmaker = matchmaker or Matchmaker()
+        self.bot_after = bot_after  # seconds a player waits before playing the AI, None for never
+        self.rooms = {}
+        self.room_of = {}
+        self.bots = set()
+        # Set when players wait in the broker's queue and may be seated on other nodes
+        self.remote_seats = False
+        self.remote_players = {}  # username -> node, for players of our rooms connected elsewhere
+        self.player_channels = {}  # username -> callback of their channel, for our own players
+        # Worker processes number their rooms first_room_id, first_room_id + step, ... so
+        # room ids stay unique across the whole server
+        self.next_room_id = first_room_id
+        self.room_id_step = room_id_step
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def hosted(self):
+        return sum(1 for room in self.rooms.values() if not isinstance(room, RemoteRoom))
+
+    def get(self, room_id):
+        # A room hosted by another node is looked up in the directory and watched through a
+        # local RemoteRoom, which closes like any other room once nobody is left in it
+        room = self.rooms.get(room_id)
+        directory = self.server.directory
+        if room is None and directory is not None:
+            node = directory.lookup(room_id)
+            if node is not None and node != self.server.node:
+                room = RemoteRoom(self, room_id, node)
+                self.rooms[room_id] = room
+        return room
+
+    def create_room(self):
+        room = Room(self, self.next_room_id)
+        self.next_room_id += self.room_id_step
+        self.rooms[room.room_id] = room
+        if self.server.directory is not None:
+            self.server.directory.register(room.room_id, self.server.node)
+        return room
+
+    def refresh(self, room):
+        # Called from the room's own commands after any change of its seats
+        if not room.members() and not room.pending_players and not room.commands:
+            self.rooms.pop(room.room_id, None)
+            room.close()
+            self.server.observer.on_room_closed(room.room_id)
+
+    def node_message(self, data):
+        # Pairs made by the broker and the seats they lead to, other nodes asking for the
+        # spectator traffic of one of our rooms or posting their users' chat to it, and
+        # what players of our rooms do on the node holding their connection
+        command, _, rest = decode(data).partition(" ")
+        if command == "pair":
+            self.pair(*json.loads(rest))
+            return
+        if command == "seat":
+            self.seat_remote(*json.loads(rest))
+            return
+        if command == "unpaired":
+            self.matchmaker.requeue(rest)
+            return
+        room_id, _, line = rest.partition(" ")
+        room = self.rooms.get(int(room_id))
+        if room is None or isinstance(room, RemoteRoom):
+            return
+        if command == "watch":
+            room.submit(room.watch)
+        elif command == "unwatch":
+            room.submit(room.unwatch)
+        elif command == "chat":
+            room.submit(room.chat, line)
+        elif command == "move":
+            cell, _, username = line.partition(" ")
+            if self.seated_remotely(room, username):
+                room.submit(room.handle_move, self.server.clients[username], username, int(cell))
+        elif self.seated_remotely(room, line):
+            client = self.server.clients[line]
+            if command == "board":
+                room.submit(room.send_board, client)
+            elif command == "away":
+                room.submit(room.player_away, line)
+            elif command == "resume":
+                room.submit(room.resume, line, client)
+            elif command == "leave":
+                self.leave(line, then=lambda: self.server.forget_client(client, line))
+
+    def seated_remotely(self, room, username):
+        return username in self.remote_players and self.room_of.get(username) is room
+
+    def pair(self, first, second, node, rating):
+        # The broker paired first, who waits here, with second, who waits on node. The one
+        # who waited longer comes first and their node hosts the room.
+        if node == self.server.node:
+            players = [username for username in (first, second) if self.matchmaker.take(username)]
+            if len(players) == 2:
+                self.open_room(*players)
+            else:
+                # One of them left in the meantime, the other waits again
+                for username in players:
+                    self.join_as_player(username)
+            return
+        directory = self.server.directory
+        if second in self.server.clients or not self.matchmaker.take(first):
+            # Names are only unique per node, so second may not fit here
+            directory.publish(node_channel(node), encode(f"unpaired {second}"))
+            self.matchmaker.requeue(first)
+            return
+        room = self.create_room()
+        # Sent before anything the room sends second, so their node has seated them by then
+        directory.publish(node_channel(node), encode(f"seat {json.dumps([second, room.room_id, self.server.node])}"))
+        self.server.clients[second] = RemotePlayer(directory, node, second, room.room_id)
+        self.remote_players[second] = node
+        self.matchmaker.ratings[second] = rating
+        self.open_room(first, second, room)
+
+    def seat_remote(self, username, room_id, node):
+        # A player waiting here was seated in a room of node
+        if not self.matchmaker.take(username):
+            self.server.directory.publish(node_channel(node), encode(f"leave {room_id} {username}"))
+            return
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = RemoteRoom(self, room_id, node)
+            self.rooms[room_id] = room
+        self.room_of[username] = room
+        room.pending_players += 1
+        room.submit(self.seat_player, room, username)
+
+    def listen(self, username):
+        # Subscribed before the player first waits in the broker's queue, so a hosting node
+        # can't send them anything before it is delivered here
+        if username not in self.player_channels:
+            callback = self.player_channels[username] = lambda data: self.player_message(username, data)
+            self.server.directory.subscribe(player_channel(self.server.node, username), callback)
+
+    def player_message(self, username, data):
+        # What the node hosting a player's room sends them, see RemotePlayer
+        room_id, kind, line = (decode(data).split(" ", 2) + [""])[:3]
+        room = self.room_of.get(username)
+        client = self.server.clients.get(username)
+        if (not isinstance(room, RemoteRoom) or str(room.room_id) != room_id or username not in room.players
+                or client is None):
+            return
+        if kind == "send":
+            client.send(encode(line))
+        elif kind == "chat":
+            client.send_chat(encode(line))
+        elif kind == "result":
+            result, _, rating = line.partition(" ")
+            self.matchmaker.ratings[username] = int(rating)
+            if self.server.stats is not None:
+                self.server.stats.record(username, result, int(rating))
+        elif kind == "requeue":
+            room.submit(self.vacate, room, username, lambda: self.join_as_player(username))
+        elif kind == "close":
+            room.submit(self.vacate, room, username, client.close)
+
+    def vacate(self, room, username, then):
+        # The hosting node let go of the player
+        if username in room.players:
+            room.players.remove(username)
+            room.changed()
+        if self.room_of.get(username) is room:
+            del self.room_of[username]
+        self.refresh(room)
+        then()
+
+    def forget(self, username):
+        # The user is gone from this node
+        callback = self.player_channels.pop(username, None)
+        if callback is not None:
+            self.server.directory.unsubscribe(player_channel(self.server.node, username), callback)
+        if self.remote_players.pop(username, None) is not None:
+            self.matchmaker.ratings.pop(username, None)
+
+    def join_as_player(self, username):
+        if username not in self.server.clients:
+            return
+        if self.remote_seats:
+            self.listen(username)
+        opponent = self.matchmaker.enqueue(username, time.monotonic())
+        if opponent is None:
+            self.server.clients[username].send(encode(
+                f"MESSAGE Waiting for an opponent (rating {self.matchmaker.rating(username)})"))
+        else:
+            self.open_room(opponent, username)
+
+    def match_waiting(self):
+        # Called periodically so the rating windows of waiting players can widen
+        now = time.monotonic()
+        for first, second in self.matchmaker.match_waiting(now):
+            self.open_room(first, second)
+        if self.bot_after is not None:
+            for username in self.matchmaker.waited(now, self.bot_after):
+                self.matchmaker.remove(username)
+                self.open_room_with_bot(username)
+
+    def open_room(self, first, second, room=None):
+        room = room or self.create_room()
+        for username in (first, second):
+            self.room_of[username] = room
+            # The seat is promised now so the room can't close before its command runs
+            room.pending_players += 1
+            room.submit(self.seat_player, room, username)
+
+    def open_room_with_bot(self, username):
+        room = self.create_room()
+        bot_name = f"AI-{room.room_id}"
+        while bot_name in self.server.clients:
+            bot_name += "'"
+        self.server.clients[bot_name] = BotClient(room, bot_name)
+        self.bots.add(bot_name)
+        for player in (username, bot_name):
+            self.room_of[player] = room
+            room.pending_players += 1
+            room.submit(self.seat_player, room, player)
+
+    def remove_bot(self, bot_name):
+        self.bots.discard(bot_name)
+        self.room_of.pop(bot_name, None)
+        self.server.clients.pop(bot_name, None)
+
+    def record_result(self, first, second, score):
+        # Games against the AI don't move ratings, but still count as wins and losses
+        if first not in self.bots and second not in self.bots:
+            self.matchmaker.record_result(first, second, score)
+        stats = self.server.stats
+        for username, result in ((first, score), (second, 1 - score)):
+            if username in self.remote_players:
+                # Their node keeps their stats
+                rating = self.matchmaker.rating(username)
+                self.server.clients[username].post(f"result {RESULTS[result]} {rating}")
+            elif stats is not None and username not in self.bots:
+                stats.record(username, RESULTS[result], self.matchmaker.rating(username))
+
+    def seat_player(self, room, username):
+        room.pending_players -= 1
+        room.add_player(username)
+        self.refresh(room)
+        if room.game is None and len(room.players) == 2:
+            room.start_game()
+
+    def join_as_spectator(self, username, room):
+        if self.rooms.get(room.room_id) is not room:
+            # The room closed while the user was leaving the old one
+            self.server.clients[username].send(encode("MESSAGE No such room"))
+            self.join_as_player(username)
+            return
+        self.room_of[username] = room
+        room.submit(self.seat_spectator, room, username)
+
+    def seat_spectator(self, room, username):
+        room.add_spectator(username)
+        self.refresh(room)
+
+    def leave(self, username, then=None):
+        # then() runs once the room has let the user go
+        room = self.room_of.pop(username, None)
+        if room is None:
+            self.matchmaker.remove(username)
+            if then is not None:
+                then()
+            return
+        room.submit(self.unseat, room, username, then)
+
+    def unseat(self, room, username, then):
+        try:
+            room.remove(username)
+            if room.game is None:
+                # A player left without a replacement, the one still seated looks for
+                # a new opponent
+                for player in list(room.players):
+                    room.players.remove(player)
+                    if player in self.bots:
+                        self.remove_bot(player)
+                        continue
+                    self.room_of.pop(player, None)
+                    if player in self.remote_players:
+                        # They wait again on their own node
+                        client = self.server.clients[player]
+                        client.post("requeue")
+                        self.server.forget_client(client, player)
+                        continue
+                    self.join_as_player(player)
+                room.changed()
+            self.refresh(room)
+        finally:
+            if then is not None:
+                then()
+
+    def clear(self):
+        for room in self.rooms.values():
+            room.close()
+        self.bots.clear()
+        self.rooms.clear()
+        self.room_of.clear()
+        self.remote_players.clear()
+        self.player_channels.clear()
+        self.matchmaker.queue.clear()
+        self.matchmaker.waiting.clear()
@@ -0,0 +1,161 @@
+import asyncio
+import sqlite3
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from matchmaking import DEFAULT_RATING
+
+FLUSH_INTERVAL = 1
+FLUSH_SIZE = 500
+SELECT_CHUNK = 500
+
+PlayerStats = namedtuple("PlayerStats", "wins losses draws rating")
+NEW_PLAYER = PlayerStats(0, 0, 0, DEFAULT_RATING)
+RESULT_FIELDS = {"win": 0, "loss": 1, "draw": 2}
+
+
+class StatsStore:
+    # Wins, losses, draws and rating of every player in SQLite. The engine only ever touches
+    # memory: reads come from an LRU cache, results are queued as increments and a task
+    # writes them in one transaction per second from a helper thread. Players missing from
+    # the cache are read in the same round trip, after the writes, so nothing queued is lost.
+    def __init__(self, path, cache_size=10000):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # username -> PlayerStats
+        self.dirty = {}  # username -> [wins, losses, draws, rating] still to write
+        self.loading = {}  # username -> future of its PlayerStats
+        self.db = None
+        self.log = None
+        self.task = None
+        self.executor = None
+        self.wakeup = None
+
+    async def load(self, username):
+        stats = self.cache.get(username)
+        if stats is not None:
+            self.cache.move_to_end(username)
+            return stats
+        future = self.loading.get(username)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.loading[username] = future
+            self.wakeup.set()
+        return await asyncio.shield(future)
+
+    def record(self, username, result, rating):
+        # result is "win", "loss" or "draw", rating the rating after the game
+        pending = self.dirty.get(username)
+        if pending is None:
+            pending = self.dirty[username] = [0, 0, 0, rating]
+        pending[RESULT_FIELDS[result]] += 1
+        pending[3] = rating
+        stats = self.cache.get(username)
+        if stats is not None:
+            counts = list(stats[:3])
+            counts[RESULT_FIELDS[result]] += 1
+            self.cache[username] = PlayerStats(*counts, rating)
+            self.cache.move_to_end(username)
+        if len(self.dirty) >= FLUSH_SIZE and self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self, log):
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if not self.dirty and not self.loading:
+                continue
+            batch, self.dirty = self.dirty, {}
+            loading, self.loading = self.loading, {}
+            try:
+                rows = await loop.run_in_executor(self.executor, self.sync, batch, list(loading))
+                cache = True
+            except sqlite3.Error as e:
+                self.log(f"Player stats not saved: {str(e)}", "error")
+                for username, pending in batch.items():
+                    self.merge(username, pending)
+                rows = {}
+                cache = False
+            for username, future in loading.items():
+                stats = rows.get(username, NEW_PLAYER)
+                pending = self.dirty.get(username)
+                if pending is not None:
+                    # Results recorded while the row was being read
+                    stats = PlayerStats(*(stats[i] + pending[i] for i in range(3)), pending[3])
+                if cache:
+                    self.cache[username] = stats
+                if not future.done():
+                    future.set_result(stats)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def merge(self, username, pending):
+        current = self.dirty.get(username)
+        if current is None:
+            self.dirty[username] = pending
+        else:
+            for i in range(3):
+                current[i] += pending[i]
+
+    def connect(self):
+        # WAL and a busy timeout let the worker processes share one database
+        self.db = sqlite3.connect(self.path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS players (username TEXT PRIMARY KEY, wins INTEGER NOT NULL, "
+                        "losses INTEGER NOT NULL, draws INTEGER NOT NULL, rating INTEGER NOT NULL)")
+        self.db.commit()
+
+    def sync(self, batch, usernames):
+        # Runs on the helper thread, which owns the connection
+        if self.db is None:
+            self.connect()
+        if batch:
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO players (username, wins, losses, draws, rating) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (username) DO UPDATE SET wins = wins + excluded.wins, "
+                    "losses = losses + excluded.losses, draws = draws + excluded.draws, rating = excluded.rating",
+                    [(username, *pending) for username, pending in batch.items()])
+        rows = {}
+        for i in range(0, len(usernames), SELECT_CHUNK):
+            chunk = usernames[i:i + SELECT_CHUNK]
+            cursor = self.db.execute(
+                f"SELECT username, wins, losses, draws, rating FROM players "
+                f"WHERE username IN ({', '.join('?' * len(chunk))})", chunk)
+            for username, *stats in cursor:
+                rows[username] = PlayerStats(*stats)
+        return rows
+
+    def close(self):
+        # Writes what is still queued and waits for it
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        batch, self.dirty = self.dirty, {}
+        executor = self.executor or ThreadPoolExecutor(max_workers=1)
+        self.executor = None
+        try:
+            executor.submit(self.finish, batch).result()
+        except sqlite3.Error as e:
+            if self.log is not None:
+                self.log(f"Player stats not saved: {str(e)}", "error")
+        executor.shutdown(wait=True)
+
+    def finish(self, batch):
+        try:
+            if batch:
+                self.sync(batch, [])
+        finally:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
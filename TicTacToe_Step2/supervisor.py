@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from directory import Broker
+from engine import MATCHMAKING_INTERVAL, GameServer, ServerObserver, add_engine_arguments, engine_options
+from matchmaking import Matchmaker, SharedMatchmaker
+from protocol import BINARY, MAX_FRAME, decode
+
+HANDSHAKE_TIMEOUT = 10
+RESTART_DELAY = 1
+
+
+class WorkerObserver(ServerObserver):
+    # Tells the supervisor which usernames this worker owns, so a returning user is sent
+    # back to the worker holding their room
+    def __init__(self, index, channel):
+        self.index = index
+        self.channel = channel
+
+    def on_client_joined(self, username):
+        self.notify(f"own {username}")
+
+    def on_client_left(self, username):
+        self.notify(f"release {username}")
+
+    def on_client_rejected(self, username):
+        self.notify(f"release {username}")
+
+    def on_session_started(self, username, token):
+        self.notify(f"session {token} {username}")
+
+    def notify(self, message):
+        try:
+            self.channel.send(message.encode())
+        except OSError:
+            pass  # ownership is only a routing hint, the supervisor falls back to round robin
+
+
+def worker_main(index, workers, channel, options, pair_here):
+    # Every worker is a node of the room directory. Room ids interleave over the workers
+    # of this node, and over the nodes sharing the broker. The supervisor pairs the players
+    # of its workers, unless they wait in the queue of a broker shared with other servers.
+    options = dict(options)
+    node_slot = options.pop("first_room_id", 1) - 1
+    nodes = options.pop("room_id_step", 1)
+    if options.get("node"):
+        options["node"] = f"{options['node']}-{index}"
+    logs = options["logs"]
+    logs.fields["worker"] = index
+    if logs.path:
+        logs.path = f"{logs.path}.{index}"
+    if options.get("replays") is not None:
+        options["replays"].prefix = f"games-{index}"
+    if options.get("metrics_port") is not None:
+        options["metrics_port"] += index
+    engine = GameServer(WorkerObserver(index, channel), first_room_id=node_slot * workers + index + 1,
+                        room_id_step=nodes * workers, **options)
+    if pair_here:
+        engine.rooms.matchmaker = SharedMatchmaker(engine.observer.notify)
+    try:
+        asyncio.run(serve_worker(engine, channel))
+    except KeyboardInterrupt:
+        engine.close_stores()
+
+
+async def serve_worker(engine, channel):
+    # The supervisor sends connections ("connect" or "adopt" with the socket attached) and
+    # the pairings its matchmaking made ("pair", "send" and "requeue")
+    loop = asyncio.get_running_loop()
+    channel.setblocking(False)
+    rooms = engine.rooms
+    matchmaker = rooms.matchmaker
+
+    def receive():
+        try:
+            data, fds, _, _ = socket.recv_fds(channel, 2 * MAX_FRAME, 1)
+        except BlockingIOError:
+            return
+        if not data and not fds:
+            # The supervisor is gone
+            loop.remove_reader(channel)
+            engine.stop()
+            return
+        header, _, data = data.partition(b"\n")
+        command, _, args = decode(header).partition(" ")
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            if command == "connect":
+                loop.create_task(engine.adopt(sock, data))
+            elif command == "adopt":
+                opponent, state = json.loads(args)
+                loop.create_task(engine.adopt_player(sock, data, state, lambda username: seat(opponent, username)))
+        if command == "pair":
+            players = [username for username in json.loads(args) if matchmaker.take(username)]
+            if len(players) == 2:
+                rooms.open_room(*players)
+            else:
+                # One of them left in the meantime, the other waits again
+                for username in players:
+                    rooms.join_as_player(username)
+        elif command == "send":
+            username, index, opponent = json.loads(args)
+            loop.create_task(send_player(username, index, opponent))
+        elif command == "requeue":
+            matchmaker.requeue(args)
+
+    def seat(opponent, username):
+        # A player handed over to be paired with opponent, who waits here
+        if matchmaker.take(opponent):
+            rooms.open_room(opponent, username)
+        else:
+            rooms.join_as_player(username)
+
+    async def send_player(username, index, opponent):
+        # Hands a player waiting here to worker index, where opponent waits for them
+        moved = await engine.detach(username) if matchmaker.take(username) else None
+        if moved is None:
+            engine.observer.notify(f"unpaired {index} {opponent}")
+            return
+        sock, data, state = moved
+        try:
+            await send_packet(channel, f"moved {json.dumps([index, opponent, state])}\n".encode() + data, sock)
+        except OSError:
+            engine.observer.notify(f"unpaired {index} {opponent}")
+        finally:
+            sock.close()
+
+    await engine.start_directory()
+    loop.add_reader(channel, receive)
+    engine.log("Worker started")
+    await engine.serve()
+
+
+async def send_packet(channel, data, sock=None):
+    # One message on a worker channel, waiting while the channel is full
+    loop = asyncio.get_running_loop()
+    fds = [sock.fileno()] if sock is not None else []
+    while True:
+        try:
+            socket.send_fds(channel, [data], fds)
+            return
+        except BlockingIOError:
+            writable = loop.create_future()
+            loop.add_writer(channel, lambda: writable.done() or writable.set_result(None))
+            try:
+                await writable
+            finally:
+                loop.remove_writer(channel)
+
+
+class Supervisor:
+    # Accepts every connection, reads the username and passes the socket to a worker
+    # process. Each room lives in exactly one worker. Players waiting for an opponent are
+    # matched here, over all workers: the one who waited less is handed to the worker of
+    # the other, who hosts their room. With a broker shared with other servers they are
+    # matched by the broker instead, like the players of any node.
+    def __init__(self, workers, options):
+        self.workers = workers
+        self.options = options
+        self.channels = [None] * workers
+        self.processes = [None] * workers
+        self.owner = {}  # username -> index of the worker holding it
+        self.sessions = {}  # session token -> username, so RESUME finds the same worker
+        self.tokens = {}  # username -> session token
+        self.round_robin = itertools.cycle(range(workers))
+        self.matchmaker = Matchmaker()
+        self.waiting_on = {}  # username -> index of the worker of a player in the queue
+        self.loop = None
+        self.broker = None
+
+    def log(self, message):
+        print(message, flush=True)
+
+    def start_worker(self, index):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        # spawn rather than fork, so workers don't inherit the supervisor's end of the channels
+        # and notice when it goes away
+        process = multiprocessing.get_context("spawn").Process(
+            target=worker_main, args=(index, self.workers, worker_channel, self.options, self.broker is not None),
+            daemon=True)
+        process.start()
+        worker_channel.close()
+        channel.setblocking(False)
+        self.channels[index] = channel
+        self.processes[index] = process
+        self.loop.add_reader(channel, self.read_channel, index, channel)
+
+    def read_channel(self, index, channel):
+        try:
+            data, fds, _, _ = socket.recv_fds(channel, 2 * MAX_FRAME, 1)
+        except BlockingIOError:
+            return
+        except OSError:
+            data, fds = b"", []
+        if not data:
+            self.worker_exited(index, channel)
+            return
+        if fds:
+            # A player handed over for a pairing, passed on to the worker hosting the room
+            header, _, rest = data.partition(b"\n")
+            target, opponent, state = json.loads(header.decode().split(" ", 1)[1])
+            sock = socket.socket(fileno=fds[0])
+            self.loop.create_task(self.hand_over(
+                target, f"adopt {json.dumps([opponent, state])}\n".encode() + rest, sock))
+            return
+        command, username = data.decode(errors="replace").split(" ", 1)
+        if command == "wait":
+            rating, username = username.split(" ", 1)
+            self.enqueue(index, username, int(rating))
+        elif command == "unwait":
+            self.dequeue(username)
+        elif command == "unpaired":
+            target, username = username.split(" ", 1)
+            self.command(int(target), f"requeue {username}")
+        elif command == "own":
+            self.owner[username] = index
+        elif command == "session":
+            token, username = username.split(" ", 1)
+            self.sessions[token] = username
+            self.tokens[username] = token
+        elif command == "release":
+            # A held seat is only released once its grace period is over
+            self.release(index, username)
+
+    def release(self, index, username):
+        if self.owner.get(username) == index:
+            del self.owner[username]
+            self.sessions.pop(self.tokens.pop(username, None), None)
+
+    def worker_exited(self, index, channel):
+        self.loop.remove_reader(channel)
+        channel.close()
+        self.channels[index] = None
+        self.processes[index].join(timeout=1)
+        self.log(f"Worker {index} exited with code {self.processes[index].exitcode}, restarting")
+        for username in [username for username, owner in self.owner.items() if owner == index]:
+            del self.owner[username]
+            self.sessions.pop(self.tokens.pop(username, None), None)
+        for username in [username for username, owner in self.waiting_on.items() if owner == index]:
+            self.dequeue(username)
+        self.loop.call_later(RESTART_DELAY, self.start_worker, index)
+
+    def enqueue(self, index, username, rating):
+        self.dequeue(username)
+        self.matchmaker.ratings[username] = rating
+        self.waiting_on[username] = index
+        opponent = self.matchmaker.enqueue(username, time.monotonic())
+        if opponent is not None:
+            self.pair(opponent, username)
+
+    def dequeue(self, username):
+        self.matchmaker.remove(username)
+        self.matchmaker.ratings.pop(username, None)
+        self.waiting_on.pop(username, None)
+
+    def pair(self, first, second):
+        host = self.waiting_on[first]
+        index = self.waiting_on[second]
+        self.dequeue(first)
+        self.dequeue(second)
+        if index == host:
+            self.command(host, f"pair {json.dumps([first, second])}")
+        else:
+            self.command(index, f"send {json.dumps([second, host, first])}")
+
+    async def match_waiting(self):
+        # The rating windows of waiting players widen over time
+        while True:
+            await asyncio.sleep(MATCHMAKING_INTERVAL)
+            for first, second in self.matchmaker.match_waiting(time.monotonic()):
+                self.pair(first, second)
+
+    def command(self, index, message):
+        channel = self.channels[index]
+        if channel is not None:
+            self.loop.create_task(send_packet(channel, message.encode()))
+
+    def pick_worker(self, username):
+        index = self.owner.get(username)
+        if index is not None and self.channels[index] is not None:
+            return index
+        for _ in range(self.workers):
+            index = next(self.round_robin)
+            if self.channels[index] is not None:
+                return index
+        return None
+
+    async def run(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        sock = socket.create_server((host, port), backlog=1024)
+        sock.setblocking(False)
+        if not self.options.get("broker"):
+            # Without a shared broker the workers still see each other's rooms through one
+            # running here
+            path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+            self.broker = Broker()
+            await self.broker.start(f"unix:{path}")
+            self.options["broker"] = f"unix:{path}"
+        for index in range(self.workers):
+            self.start_worker(index)
+        self.loop.create_task(self.match_waiting())
+        self.log(f"Server started on port {port} with {self.workers} workers")
+        while True:
+            client, _ = await self.loop.sock_accept(sock)
+            self.loop.create_task(self.route(client))
+
+    async def route(self, client):
+        data = b""
+        try:
+            while b"\n" not in data:
+                chunk = await asyncio.wait_for(self.loop.sock_recv(client, 4096), HANDSHAKE_TIMEOUT)
+                if not chunk or len(data) > MAX_FRAME:
+                    client.close()
+                    return
+                data += chunk
+        except (OSError, asyncio.TimeoutError):
+            client.close()
+            return
+
+        username = decode(data.split(b"\n", 1)[0])
+        if username.startswith(BINARY):
+            username = username[len(BINARY):]
+        resume = username.startswith("RESUME ")
+        if resume:
+            username = self.sessions.get(username[len("RESUME "):], username)
+        index = self.pick_worker(username)
+        if index is None:
+            client.close()
+            return
+        claimed = not resume and username and username not in self.owner
+        if claimed:
+            # Bound before the worker confirms, so a second connection with the same name
+            # goes to the same worker and is turned away there
+            self.owner[username] = index
+        if not await self.hand_over(index, b"connect\n" + data, client) and claimed:
+            self.release(index, username)
+
+    async def hand_over(self, index, data, client):
+        try:
+            if self.channels[index] is not None:
+                await send_packet(self.channels[index], data, client)
+                return True
+        except OSError as e:
+            self.log(f"Failed to hand a connection to worker {index}: {str(e)}")
+        finally:
+            client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TicTacToe server spread over several worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    add_engine_arguments(parser)
+    args = parser.parse_args()
+
+    supervisor = Supervisor(args.workers, engine_options(args, parser))
+    try:
+        asyncio.run(supervisor.run(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
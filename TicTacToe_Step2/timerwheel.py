@@ -0,0 +1,77 @@
+import asyncio
+import math
+import time
+
+
+class Timer:
+    __slots__ = ("expires", "callback", "args", "bucket")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+
+
+class TimerWheel:
+    # Hierarchical timing wheel. Level 0 has one slot per tick, each level above has slots
+    # `slots` times coarser. Scheduling and cancelling are O(1), and a timer is moved down
+    # at most once per level before it fires, so thousands of connections can each keep
+    # their timers without a heap or a thread per connection.
+    def __init__(self, tick=0.5, bits=6, levels=4):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.wheels = [[set() for _ in range(1 << bits)] for _ in range(levels)]
+        self.current = 0  # ticks since the wheel started
+        self.started = None
+
+    def __len__(self):
+        return sum(len(bucket) for wheel in self.wheels for bucket in wheel)
+
+    def schedule(self, delay, callback, *args):
+        timer = Timer(self.current + max(1, math.ceil(delay / self.tick)), callback, args)
+        self.place(timer)
+        return timer
+
+    def place(self, timer):
+        # The lowest level whose current rotation still contains the expiry tick
+        level = 0
+        while level < self.levels - 1 and (timer.expires ^ self.current) >> (self.bits * (level + 1)):
+            level += 1
+        bucket = self.wheels[level][(timer.expires >> (self.bits * level)) & self.mask]
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def advance(self):
+        self.current += 1
+        for level in range(1, self.levels):
+            if self.current & ((1 << (self.bits * level)) - 1):
+                break
+            # A slot of this level starts now, its timers move to the finer levels
+            index = (self.current >> (self.bits * level)) & self.mask
+            bucket = self.wheels[level][index]
+            self.wheels[level][index] = set()
+            for timer in bucket:
+                self.place(timer)
+        index = self.current & self.mask
+        bucket = self.wheels[0][index]
+        self.wheels[0][index] = set()
+        for timer in bucket:
+            timer.bucket = None
+            timer.callback(*timer.args)
+
+    async def run(self):
+        # Catches up on missed ticks if the loop was busy, so timers don't drift
+        self.started = time.monotonic() - self.current * self.tick
+        while True:
+            await asyncio.sleep(self.tick)
+            target = int((time.monotonic() - self.started) / self.tick)
+            while self.current < target:
+                self.advance()